@@ -8,34 +8,63 @@ import useWebSocket, { ReadyState } from 'react-use-websocket';
 import KeyMarkerBoard from './components/KeyMarkerBoard';
 
 
+const DWELL_DURATION_SECONDS = 1.0
+
+// Key rectangles in normalized surface coordinates (origin bottom-left)
+function keyboardLayout() {
+  const keys = Array.from(document.querySelectorAll('[data-key]')).map(element => {
+    const rect = element.getBoundingClientRect()
+    return {
+      name: element.dataset.key,
+      x0: rect.left / window.innerWidth,
+      x1: rect.right / window.innerWidth,
+      y0: 1 - rect.bottom / window.innerHeight,
+      y1: 1 - rect.top / window.innerHeight,
+    }
+  })
+  return { type: "layout", dwell_duration: DWELL_DURATION_SECONDS, keys }
+}
+
+
 function App() {
   const { height: windowHeight, width: windowWidth } = useWindowDimensions();
   // const cursorPosition = useMousePosition();
-  const { lastJsonMessage } = useWebSocket('ws://localhost:8001');
-  const cursorPosition = React.useMemo(() => {
+  const { lastJsonMessage, sendJsonMessage, readyState } = useWebSocket('ws://localhost:8001');
 
-    let point = {
-      x: 0,
-      y: 0,
+  // Let the server hit-test gaze against the keys and send hover/trigger events
+  React.useEffect(() => {
+    if (readyState === ReadyState.OPEN) {
+      sendJsonMessage(keyboardLayout())
     }
-    if (lastJsonMessage) {
-      point = {
+  }, [readyState, windowWidth, windowHeight]);
+
+  // Acknowledge rendered gaze so the server can measure the glass-to-browser latency
+  React.useEffect(() => {
+    if (lastJsonMessage && lastJsonMessage.timestamp !== undefined) {
+      sendJsonMessage({ type: "ack", timestamp: lastJsonMessage.timestamp })
+    }
+  }, [lastJsonMessage]);
+
+  const keyEvent = lastJsonMessage && lastJsonMessage.type ? lastJsonMessage : null
+  // Gaze positions arrive between the key events; keep the last one until the next
+  const [cursorPosition, setCursorPosition] = React.useState(null)
+  React.useEffect(() => {
+    if (lastJsonMessage && lastJsonMessage.x !== undefined) {
+      setCursorPosition({
         x: lastJsonMessage.x * windowWidth,
         y: windowHeight - lastJsonMessage.y * windowHeight,
-      }
+      })
     }
-    console.log(point);
-    return point;
   }, [lastJsonMessage]);
 
 
   return (
     <>
       {/* <MarkerBorder markerSize="8vw">
-        <KeyBoard cursorPosition={cursorPosition} />
+        <KeyBoard keyEvent={keyEvent} />
       </MarkerBorder> */}
-      <KeyMarkerBoard cursorPosition={cursorPosition} />
-      <div className="cursor" style={{ "--cursorX": cursorPosition.x + "px", "--cursorY": cursorPosition.y + "px" }}></div>
+      <KeyMarkerBoard keyEvent={keyEvent} />
+      {cursorPosition && <div className="cursor" style={{ "--cursorX": cursorPosition.x + "px", "--cursorY": cursorPosition.y + "px" }}></div>}
     </>
   )
 }
@@ -1,45 +1,36 @@
 import React from 'react'
 import "./Key.css"
 
-export default function Key({ value, onTrigger, cursorPosition }) {
-    const containerRef = React.useRef(null)
-    const [hover, setHover] = React.useState(false)
+export default function Key({ value, onTrigger, gazeHovered = false, triggeredAt = null }) {
+    const [mouseHover, setMouseHover] = React.useState(false)
     const [activation, setActivation] = React.useState(0.0)
+    const hover = mouseHover || gazeHovered
     const color = `hsl(184, 48%, ${45 + 35 * activation}%)`
     const style = { "--hover-color": color }
 
     function updateActivation() {
-        if (!hover && activation > 0) {
-            setActivation(0)
-            return
-        }
-
         if (hover && activation < 1) {
             setActivation(prevActivation => prevActivation + 0.1)
         }
 
-        if (hover && activation >= 1) {
+        // Gaze dwell triggers are decided by the server, mouse dwell triggers here
+        if (mouseHover && activation >= 1) {
             onTrigger(value)
             setActivation(0)
         }
     }
 
     React.useEffect(() => {
-        if (!containerRef.current) return
-
-        const rect = containerRef.current.getBoundingClientRect()
-        const hor_contained = cursorPosition.x >= rect.left && cursorPosition.x <= rect.right
-        const ver_contained = cursorPosition.y >= rect.top && cursorPosition.y <= rect.bottom
-        const contained = hor_contained && ver_contained
-
-        if (contained) {
-            setHover(true)
-        } else {
-            setHover(false)
+        if (!hover) {
             setActivation(0)
         }
+    }, [hover])
 
-    }, [cursorPosition])
+    React.useEffect(() => {
+        if (triggeredAt !== null) {
+            setActivation(0)
+        }
+    }, [triggeredAt])
 
     React.useEffect(() => {
         if (hover) {
@@ -49,16 +40,15 @@ export default function Key({ value, onTrigger, cursorPosition }) {
     }, [hover, activation]);
 
     function onMouseEnter() {
-        setHover(true)
+        setMouseHover(true)
     }
 
     function onMouseLeave() {
-        setHover(false)
-        setActivation(0)
+        setMouseHover(false)
     }
 
     return (
-        <div className='keyContainer' ref={containerRef}>
+        <div className='keyContainer' data-key={value}>
             <div style={style} className='key' onMouseEnter={onMouseEnter} onMouseLeave={onMouseLeave}>{value}</div>
         </div>
     )
@@ -4,16 +4,35 @@ import "./KeyBoard.css"
 import { Grid } from '@mui/material'
 
 
-export default function KeyBoard({ cursorPosition }) {
+export default function KeyBoard({ keyEvent }) {
     const [text, setText] = React.useState("")
+    const [hoveredKey, setHoveredKey] = React.useState(null)
     const keys = []
 
+    // Hover and trigger events are sent by the server, see gaze_keyboard.py
+    React.useEffect(() => {
+        if (!keyEvent) return
+
+        if (keyEvent.type === "hover") {
+            setHoveredKey(keyEvent.key)
+        }
+        if (keyEvent.type === "trigger") {
+            if (keyEvent.key === "space") {
+                appendValue(" ")
+            } else if (keyEvent.key === "reset") {
+                resetText()
+            } else {
+                appendValue(keyEvent.key)
+            }
+        }
+    }, [keyEvent])
+
     const letters = ["A", "B", "C", "D", "E", "F", "G", "H", "I", "J", "K", "L", "M", "N", "O", "P", "Q", "R", "S", "T", "U", "V", "W", "X", "Y", "Z"]
     for (let i = 0; i < letters.length; i++) {
-        keys.push(<Key key={i} value={letters[i]} onTrigger={appendValue} cursorPosition={cursorPosition} />)
+        keys.push(<Key key={i} value={letters[i]} onTrigger={appendValue} gazeHovered={hoveredKey === letters[i]} />)
     }
-    keys.push(<Key key={keys.length} value={"space"} onTrigger={() => appendValue(" ")} cursorPosition={cursorPosition} />)
-    keys.push(<Key key={keys.length} value={"reset"} onTrigger={resetText} cursorPosition={cursorPosition} />)
+    keys.push(<Key key={keys.length} value={"space"} onTrigger={() => appendValue(" ")} gazeHovered={hoveredKey === "space"} />)
+    keys.push(<Key key={keys.length} value={"reset"} onTrigger={resetText} gazeHovered={hoveredKey === "reset"} />)
 
     function appendValue(value) {
         setText(prevText => prevText + value)
@@ -4,14 +4,36 @@ import "./KeyMarkerBoard.css"
 
 
 
-export default function KeyMarkerBoard({ cursorPosition }) {
+export default function KeyMarkerBoard({ keyEvent }) {
     const [text, setText] = React.useState("")
+    const [hoveredKey, setHoveredKey] = React.useState(null)
+    const [lastTrigger, setLastTrigger] = React.useState({ key: null, timestamp: null })
     const marker_names = ['tag36_11_00000.png', 'tag36_11_00001.png', 'tag36_11_00002.png', 'tag36_11_00003.png', 'tag36_11_00004.png', 'tag36_11_00005.png', 'tag36_11_00006.png', 'tag36_11_00007.png', 'tag36_11_00008.png', 'tag36_11_00009.png', 'tag36_11_00010.png', 'tag36_11_00011.png', 'tag36_11_00012.png', 'tag36_11_00013.png', 'tag36_11_00014.png', 'tag36_11_00015.png', 'tag36_11_00016.png', 'tag36_11_00017.png', 'tag36_11_00018.png', 'tag36_11_00019.png', 'tag36_11_00020.png', 'tag36_11_00021.png', 'tag36_11_00022.png', 'tag36_11_00023.png', 'tag36_11_00024.png', 'tag36_11_00025.png']
     const letters = ["A", "B", "C", "D", "E", "F", "G", "H", "I", "J", "K", "L", "M", "N", "O", "P", "Q", "R", "S", "T", "U", "V", "W", "X", "Y", "Z",]
 
+    // Hover and trigger events are sent by the server, see gaze_keyboard.py
+    React.useEffect(() => {
+        if (!keyEvent) return
+
+        if (keyEvent.type === "hover") {
+            setHoveredKey(keyEvent.key)
+        }
+        if (keyEvent.type === "trigger") {
+            triggerKey(keyEvent.key)
+            setLastTrigger({ key: keyEvent.key, timestamp: keyEvent.timestamp })
+        }
+    }, [keyEvent])
+
+    function gazeProps(value) {
+        return {
+            gazeHovered: hoveredKey === value,
+            triggeredAt: lastTrigger.key === value ? lastTrigger.timestamp : null,
+        }
+    }
+
     const boardItems = letters.map((l, i) => (
         <div className="gridItem">
-            <Key key={i} value={l} onTrigger={appendValue} cursorPosition={cursorPosition} />
+            <Key key={i} value={l} onTrigger={appendValue} {...gazeProps(l)} />
         </div>
     ))
 
@@ -45,6 +67,16 @@ export default function KeyMarkerBoard({ cursorPosition }) {
         setText("")
     }
 
+    function triggerKey(value) {
+        if (value === "space") {
+            appendValue(" ")
+        } else if (value === "reset") {
+            resetText()
+        } else {
+            appendValue(value)
+        }
+    }
+
     return (
         <div className='gridContainer'>
             {boardItems.map((key, i) => (
@@ -53,14 +85,14 @@ export default function KeyMarkerBoard({ cursorPosition }) {
                 </div>
             ))}
             <div className="gridItem">
-                <Key key={"space"} value={"space"} onTrigger={() => appendValue(" ")} cursorPosition={cursorPosition} />
+                <Key key={"space"} value={"space"} onTrigger={() => appendValue(" ")} {...gazeProps("space")} />
             </div>
             <div className="gridItem input">
                 <input type="text" value={text} onChange={() => null} />
             </div>
 
             <div className="gridItem">
-                <Key key={"reset"} value={"reset"} onTrigger={resetText} cursorPosition={cursorPosition} />
+                <Key key={"reset"} value={"reset"} onTrigger={resetText} {...gazeProps("reset")} />
             </div>
         </ div>
     )
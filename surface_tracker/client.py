@@ -1,10 +1,17 @@
 import asyncio
 import websockets
 
+import gaze_protocol
+
 async def hello():
-    async with websockets.connect("ws://localhost:8765") as websocket:
+    async with websockets.connect(
+        "ws://localhost:8001", subprotocols=gaze_protocol.SUBPROTOCOLS
+    ) as websocket:
         # print("send hello")
         # await websocket.send("Hello world!")
-        print("response: ", await websocket.recv())
+        message = await websocket.recv()
+        if websocket.subprotocol == gaze_protocol.BINARY_SUBPROTOCOL:
+            message = gaze_protocol.decode_binary(message)
+        print("response: ", message)
 
-asyncio.run(hello())
\ No newline at end of file
+asyncio.run(hello())
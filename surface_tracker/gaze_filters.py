@@ -0,0 +1,163 @@
+"""Streaming filters for surface-mapped gaze.
+
+Every filter keeps its state in small NumPy arrays and processes batches of samples;
+a single sample is simply a batch of one. `GazeFilterStage` applies an independent
+filter instance per surface to the mapped gaze of each processed frame.
+"""
+import abc
+from typing import Callable, Dict, Optional, Tuple
+
+import numpy as np
+import numpy.typing as npt
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Smallest time step used for samples with identical timestamps
+_MIN_DT = 1e-6
+
+
+class GazeFilter(abc.ABC):
+    @abc.abstractmethod
+    def filter(
+        self,
+        timestamps: npt.NDArray[np.float64],
+        points: npt.NDArray[np.float64],
+    ) -> npt.NDArray[np.float64]:
+        """Filter a batch of Nx2 points with N timestamps (seconds), in order"""
+
+    @abc.abstractmethod
+    def reset(self) -> None:
+        pass
+
+
+class ExponentialFilter(GazeFilter):
+    """First-order low-pass filter with time constant `tau` seconds"""
+
+    def __init__(self, tau: float = 0.05):
+        self._tau = tau
+        self.reset()
+
+    def reset(self) -> None:
+        self._state: Optional[npt.NDArray[np.float64]] = None
+        self._last_timestamp = 0.0
+
+    def filter(self, timestamps, points):
+        if not len(points):
+            return points
+        if self._state is None:
+            self._state = points[0].copy()
+            self._last_timestamp = timestamps[0]
+
+        dt = np.diff(timestamps, prepend=self._last_timestamp)
+        decay = np.exp(-np.maximum(dt, 0.0) / self._tau)
+
+        # Closed form of y[i] = decay[i] * y[i-1] + (1 - decay[i]) * x[i]
+        cumulative = np.cumprod(decay)
+        if cumulative[-1] > 1e-12:
+            weighted = np.cumsum(((1.0 - decay) / cumulative)[:, None] * points, axis=0)
+            filtered = cumulative[:, None] * (self._state + weighted)
+        else:
+            # Long gaps underflow the closed form; fall back to the recursion
+            filtered = np.empty_like(points)
+            state = self._state
+            for i in range(len(points)):
+                state = decay[i] * state + (1.0 - decay[i]) * points[i]
+                filtered[i] = state
+
+        self._state = filtered[-1].copy()
+        self._last_timestamp = timestamps[-1]
+        return filtered
+
+
+class MedianFilter(GazeFilter):
+    """Running median over the last `window` samples"""
+
+    def __init__(self, window: int = 5):
+        self._window = window
+        self.reset()
+
+    def reset(self) -> None:
+        self._history = np.empty((0, 2), dtype=np.float64)
+
+    def filter(self, timestamps, points):
+        if not len(points):
+            return points
+        samples = np.concatenate((self._history, points))
+        # Pad the start of the stream with the first sample to keep the output length
+        missing = self._window - 1 - len(self._history)
+        if missing > 0:
+            samples = np.concatenate((np.repeat(samples[:1], missing, axis=0), samples))
+        windows = sliding_window_view(samples, self._window, axis=0)
+        self._history = samples[-(self._window - 1) :] if self._window > 1 else samples[:0]
+        return np.median(windows, axis=-1)
+
+
+class OneEuroFilter(GazeFilter):
+    """Speed-adaptive low-pass filter (Casiez et al., CHI 2012).
+
+    Low speeds are smoothed with `min_cutoff` Hz; the cutoff frequency grows by
+    `beta` per unit/s of speed to keep latency low during saccades.
+    """
+
+    def __init__(self, min_cutoff: float = 1.0, beta: float = 1.0, d_cutoff: float = 1.0):
+        self._min_cutoff = min_cutoff
+        self._beta = beta
+        self._d_cutoff = d_cutoff
+        self.reset()
+
+    def reset(self) -> None:
+        self._x: Optional[npt.NDArray[np.float64]] = None
+        self._dx = np.zeros(2, dtype=np.float64)
+        self._last_timestamp = 0.0
+
+    def filter(self, timestamps, points):
+        filtered = np.empty_like(points)
+        for i in range(len(points)):
+            if self._x is None:
+                self._x = points[i].copy()
+                self._last_timestamp = timestamps[i]
+                filtered[i] = self._x
+                continue
+
+            dt = max(timestamps[i] - self._last_timestamp, _MIN_DT)
+            dx = (points[i] - self._x) / dt
+            self._dx += _smoothing_factor(self._d_cutoff, dt) * (dx - self._dx)
+            cutoff = self._min_cutoff + self._beta * np.abs(self._dx)
+            self._x += _smoothing_factor(cutoff, dt) * (points[i] - self._x)
+            self._last_timestamp = timestamps[i]
+            filtered[i] = self._x
+        return filtered
+
+
+class GazeFilterStage:
+    """Filters the mapped gaze of every surface with its own `GazeFilter` instance"""
+
+    def __init__(self, filter_factory: Callable[[], GazeFilter] = OneEuroFilter):
+        self._filter_factory = filter_factory
+        self._filters: Dict[str, GazeFilter] = {}
+
+    def apply(self, mapped_gaze: Dict[str, Tuple]) -> Dict[str, Tuple]:
+        """Return `SurfaceGazeColumns` with filtered positions, by surface uid"""
+        filtered_gaze = {}
+        for surface_uid, gaze in mapped_gaze.items():
+            if not len(gaze.timestamps):
+                filtered_gaze[surface_uid] = gaze
+                continue
+            gaze_filter = self._filters.get(surface_uid)
+            if gaze_filter is None:
+                gaze_filter = self._filters[surface_uid] = self._filter_factory()
+
+            points = np.column_stack((gaze.x, gaze.y))
+            points = gaze_filter.filter(gaze.timestamps, points)
+            on_surface = np.all((points >= 0.0) & (points <= 1.0), axis=1)
+            filtered_gaze[surface_uid] = gaze._replace(
+                x=points[:, 0], y=points[:, 1], is_on_aoi=on_surface
+            )
+        return filtered_gaze
+
+    def reset(self) -> None:
+        self._filters.clear()
+
+
+def _smoothing_factor(cutoff, dt: float):
+    tau = 1.0 / (2 * np.pi * cutoff)
+    return 1.0 / (1.0 + tau / dt)
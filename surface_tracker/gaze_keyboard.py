@@ -0,0 +1,134 @@
+"""Server-side key hit-testing and dwell activation for the gaze typing client.
+
+The client describes its keyboard as a list of key rectangles in normalized surface
+coordinates (origin bottom-left, like the mapped gaze):
+
+    {"type": "layout", "dwell_duration": 1.0,
+     "keys": [{"name": "A", "x0": 0.0, "y0": 0.8, "x1": 0.14, "y1": 1.0}, ...]}
+
+Mapped gaze is then hit-tested against the layout and hover changes and key
+triggers are reported, timed by the gaze timestamps. `server.py` additionally sends
+the gaze position at a reduced rate, so that the client can keep drawing its cursor.
+"""
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+if TYPE_CHECKING:
+    from marker_mapper_lib import MarkerMappedGaze
+
+
+class Key(NamedTuple):
+    name: str
+    x0: float
+    y0: float
+    x1: float
+    y1: float
+
+    def contains(self, x: float, y: float) -> bool:
+        return self.x0 <= x <= self.x1 and self.y0 <= y <= self.y1
+
+
+class KeyEvent(NamedTuple):
+    type: str  # "hover" or "trigger"
+    key: Optional[str]
+    timestamp: float
+
+
+class KeyboardLayout:
+    """Key rectangles with a uniform grid index for constant-time hit-testing"""
+
+    def __init__(self, keys: Sequence[Key], grid_size: Tuple[int, int] = (16, 16)):
+        self.keys = list(keys)
+        self._grid_size = grid_size
+        columns, rows = grid_size
+        self._grid: List[List[int]] = [[] for _ in range(columns * rows)]
+        for index, key in enumerate(self.keys):
+            col0, row0 = self._cell(key.x0, key.y0)
+            col1, row1 = self._cell(key.x1, key.y1)
+            for row in range(row0, row1 + 1):
+                for col in range(col0, col1 + 1):
+                    self._grid[row * columns + col].append(index)
+
+    @staticmethod
+    def from_dict(value: dict) -> "KeyboardLayout":
+        try:
+            keys = [
+                Key(
+                    name=str(key["name"]),
+                    x0=float(key["x0"]),
+                    y0=float(key["y0"]),
+                    x1=float(key["x1"]),
+                    y1=float(key["y1"]),
+                )
+                for key in value["keys"]
+            ]
+        except Exception as err:
+            raise ValueError(err)
+        return KeyboardLayout(keys)
+
+    def hit_test(self, x: float, y: float) -> Optional[str]:
+        if not (0.0 <= x <= 1.0 and 0.0 <= y <= 1.0):
+            return None
+        col, row = self._cell(x, y)
+        for index in self._grid[row * self._grid_size[0] + col]:
+            key = self.keys[index]
+            if key.contains(x, y):
+                return key.name
+        return None
+
+    def _cell(self, x: float, y: float) -> Tuple[int, int]:
+        columns, rows = self._grid_size
+        col = min(max(int(x * columns), 0), columns - 1)
+        row = min(max(int(y * rows), 0), rows - 1)
+        return col, row
+
+
+class DwellKeyboard:
+    """Dwell activation state machine driven by mapped gaze timestamps.
+
+    A key triggers once gaze stayed on it for `dwell_duration` seconds, and again
+    after every further `dwell_duration` seconds. Gaps in the gaze stream longer than
+    `max_gap` seconds restart the dwell.
+    """
+
+    def __init__(
+        self,
+        layout: KeyboardLayout,
+        dwell_duration: float = 1.0,
+        max_gap: float = 0.25,
+    ):
+        self.layout = layout
+        self._dwell_duration = dwell_duration
+        self._max_gap = max_gap
+        self._hovered: Optional[str] = None
+        self._dwell_start: Optional[float] = None
+        self._last_timestamp: Optional[float] = None
+
+    @property
+    def hovered(self) -> Optional[str]:
+        return self._hovered
+
+    def update(self, gaze: Iterable[MarkerMappedGaze]) -> List[KeyEvent]:
+        events = []
+        for sample in gaze:
+            timestamp = sample.base_datum.timestamp_unix_seconds
+            if self._last_timestamp is not None and timestamp <= self._last_timestamp:
+                continue
+            key = self.layout.hit_test(sample.x, sample.y) if sample.is_on_aoi else None
+
+            has_gap = (
+                self._last_timestamp is not None
+                and timestamp - self._last_timestamp > self._max_gap
+            )
+            if key != self._hovered:
+                events.append(KeyEvent("hover", key, timestamp))
+                self._hovered = key
+                self._dwell_start = timestamp
+            elif has_gap:
+                self._dwell_start = timestamp
+            elif key is not None and timestamp - self._dwell_start >= self._dwell_duration:
+                events.append(KeyEvent("trigger", key, timestamp))
+                self._dwell_start = timestamp
+            self._last_timestamp = timestamp
+        return events
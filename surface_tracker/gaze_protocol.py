@@ -0,0 +1,71 @@
+"""Wire formats used by `server.py` to stream mapped gaze to websocket clients.
+
+Clients that offer the `BINARY_SUBPROTOCOL` during the websocket handshake receive
+binary msgpack messages, each carrying a batch of mapped gaze records:
+
+    [PROTOCOL_VERSION, [aoi_id, ...], [[timestamp, aoi_index, x, y, is_on_aoi], ...]]
+
+`aoi_index` points into the per-message list of AoI ids so that the surface uid is
+only sent once per message. Timestamps are the gaze timestamps in unix seconds.
+
+Clients that do not negotiate a subprotocol receive one JSON text message per sample.
+"""
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Dict, Iterable, List, Tuple
+
+import msgpack
+
+if TYPE_CHECKING:
+    from marker_mapper_lib import MarkerMappedGaze, MarkerMapperResult
+
+PROTOCOL_VERSION = 1
+BINARY_SUBPROTOCOL = "pupil-labs.mapped-gaze.msgpack.v1"
+SUBPROTOCOLS = [BINARY_SUBPROTOCOL]
+
+
+def mapped_gaze_records(
+    results: Iterable[MarkerMapperResult],
+) -> List[MarkerMappedGaze]:
+    return [
+        gaze
+        for result in results
+        for mapped_gaze in result.mapped_gaze.values()
+        for gaze in mapped_gaze
+    ]
+
+
+def encode_json(gaze: MarkerMappedGaze) -> Dict:
+    return {
+        "x": gaze.x,
+        "y": gaze.y,
+        "timestamp": gaze.base_datum.timestamp_unix_seconds,
+        "aoi_id": str(gaze.aoi_id),
+        "is_on_aoi": gaze.is_on_aoi,
+    }
+
+
+def encode_binary(records: Iterable[MarkerMappedGaze]) -> bytes:
+    aoi_index: Dict[str, int] = {}
+    rows = []
+    for gaze in records:
+        index = aoi_index.setdefault(str(gaze.aoi_id), len(aoi_index))
+        rows.append(
+            (
+                gaze.base_datum.timestamp_unix_seconds,
+                index,
+                gaze.x,
+                gaze.y,
+                gaze.is_on_aoi,
+            )
+        )
+    return msgpack.packb([PROTOCOL_VERSION, list(aoi_index), rows])
+
+
+def decode_binary(payload: bytes) -> List[Tuple[float, str, float, float, bool]]:
+    version, aoi_ids, rows = msgpack.unpackb(payload)
+    if version != PROTOCOL_VERSION:
+        raise ValueError(
+            f"Protocol version missmatch; expected {PROTOCOL_VERSION}, but got {version}"
+        )
+    return [(ts, aoi_ids[index], x, y, on_aoi) for ts, index, x, y, on_aoi in rows]
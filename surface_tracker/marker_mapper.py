@@ -1,16 +1,97 @@
 import asyncio
-from pupil_labs.realtime_api.simple import discover_one_device
+import contextlib
+import threading
+import time
+from typing import Callable, Iterable, Iterator, List, Optional, Set
 
-import marker_mapper_lib
-import utils_cloud_api
+from pupil_labs.realtime_api.simple import Device, discover_devices, discover_one_device
+
+from gaze_filters import GazeFilterStage, OneEuroFilter
+from utils_metrics import MarkerMapperMetrics
+from utils_startup import preload_pipeline
+
+SURFACE_DEFINITIONS_PATH = "~/pupil_capture_settings/surface_definitions_v01"
+
+
+def create_mapper(
+    camera: "marker_mapper_lib.RadialDistorsionCamera",
+    surfaces: Iterable["marker_mapper_lib.Surface"] = (),
+    metrics: Optional[MarkerMapperMetrics] = None,
+    smooth_gaze: bool = False,
+) -> "marker_mapper_lib.MarkerMapper":
+    """The mapper configuration of the live pipeline, also used to replay recordings
+
+    :param smooth_gaze: Smooth mapped gaze with a One Euro filter per surface. Reduces
+        jitter across key boundaries at the cost of some lag.
+    """
+    import marker_mapper_lib
+
+    return marker_mapper_lib.MarkerMapper(
+        camera,
+        surfaces=surfaces,
+        metrics=metrics,
+        gaze_filter=GazeFilterStage(OneEuroFilter) if smooth_gaze else None,
+        # Avoid per-frame allocations during long kiosk sessions
+        reuse_buffers=True,
+        # The markers around the keyboard barely move; search near the last ones
+        roi_tracking=True,
+    )
+
+
+def discover_scene_camera_devices(
+    max_devices: int = 1, search_duration_seconds: float = 10
+) -> List[Device]:
+    """Up to `max_devices` devices with a connected scene camera, ordered by phone id"""
+    if max_devices == 1:
+        device = discover_one_device(search_duration_seconds)
+        devices = [] if device is None else [device]
+    else:
+        devices = discover_devices(search_duration_seconds=search_duration_seconds)
+
+    usable = []
+    for device in sorted(devices, key=lambda device: device.phone_id):
+        if not device.serial_number_scene_cam:
+            print(f"Scene camera of {device.phone_name} not connected")
+        elif len(usable) < max_devices:
+            usable.append(device)
+            continue
+        device.close()
+    return usable
 
 
 class MarkerMapper:
-    def __init__(self):
-        self.device = discover_one_device(max_search_duration_seconds=10)
-        if self.device is None:
-            print("No device found.")
-            raise SystemExit(-1)
+    def __init__(
+        self,
+        full_rate_gaze: bool = False,
+        record_to: Optional[str] = None,
+        device: Optional[Device] = None,
+        surfaces: Optional[Iterable["marker_mapper_lib.Surface"]] = None,
+        smooth_gaze: bool = False,
+    ):
+        """
+        :param full_rate_gaze: Map every gaze sample as soon as it arrives, using the
+            surface locations interpolated from the most recent scene frames, which
+            are processed on a separate thread. Otherwise, gaze is mapped once per
+            scene frame together with the closest gaze sample. Best-effort: the
+            simple API only keeps the newest gaze sample, so samples arriving while
+            the previous one is mapped are skipped.
+        :param record_to: If set, scene frames, gaze, markers and results are
+            recorded to this directory, see `session_recorder.py`
+        :param device: Device to stream from, discovered if not given
+        :param surfaces: Surfaces to track, loaded from `SURFACE_DEFINITIONS_PATH`
+            if not given
+        :param smooth_gaze: Smooth mapped gaze, see `create_mapper`
+        """
+        # Load the heavy dependencies and surfaces while looking for the device
+        definitions_path = SURFACE_DEFINITIONS_PATH if surfaces is None else None
+        preloaded = preload_pipeline(definitions_path)
+        if device is None:
+            device = discover_one_device(max_search_duration_seconds=10)
+            if device is None:
+                print("No device found.")
+                raise SystemExit(-1)
+        self.device = device
+        self.device_id = device.phone_id
 
         serial_number_scene_cam = self.device.serial_number_scene_cam
         if not serial_number_scene_cam:
@@ -18,20 +99,180 @@ class MarkerMapper:
             self.device.close()
             raise SystemExit(-2)
 
+        loaded_surfaces = preloaded.result()
+        if surfaces is None:
+            surfaces = loaded_surfaces
+        import marker_mapper_lib
+        import utils_cloud_api
+
         # Setup area of interest (AoI) tracking
         camera = utils_cloud_api.camera_for_scene_cam_serial(serial_number_scene_cam)
-        self.mapper = marker_mapper_lib.MarkerMapper(camera)
-        self.mapper.add_core_surface_definitions_from_file(
-            "~/pupil_capture_settings/surface_definitions_v01"
-        )
-    
+        self.metrics = MarkerMapperMetrics()
+        self.mapper = create_mapper(camera, surfaces, self.metrics, smooth_gaze)
+        self.mapper.warm_up()
+
+        self.recorder = None
+        if record_to is not None:
+            from session_recorder import SessionRecorder
+
+            self.recorder = SessionRecorder(
+                record_to,
+                camera,
+                surfaces,
+                metrics=self.metrics,
+                smooth_gaze=smooth_gaze,
+                full_rate_gaze=full_rate_gaze,
+            )
+
+        self._gaze_columns = marker_mapper_lib.GazeColumns
+        self._should_stop = threading.Event()
+        self._frame_thread: Optional[threading.Thread] = None
+        if full_rate_gaze:
+            self._frame_thread = threading.Thread(
+                target=self._process_frames, name="MarkerMapperFrames", daemon=True
+            )
+            self._frame_thread.start()
+
+    def describe(self) -> dict:
+        return {
+            "id": self.device_id,
+            "name": self.device.phone_name,
+            "scene_camera": self.device.serial_number_scene_cam,
+        }
+
     def __call__(self):
+        if self._frame_thread is not None:
+            gaze = self.device.receive_gaze_datum()
+            received = time.time()
+            result = self.mapper.map_gaze(
+                self._gaze_columns.from_gaze_data([gaze]), base_data=[gaze]
+            )
+            if result is not None:
+                result.stage_timestamps["received"] = received
+            if self.recorder is not None:
+                self.recorder.record_gaze(gaze, result)
+            return result
+
         frame, gaze = self.device.receive_matched_scene_video_frame_and_gaze()
+        received = time.time()
+        self.metrics.observe_frame_timestamp(frame.timestamp_unix_seconds)
 
         # Process frame and gaze
         # 1. Marker detection
         # 2. AoI localisation
         # 3. Mapping gaze to AoI
         result = self.mapper.process_frame(frame.bgr_pixels, [gaze])
+        if result is not None:
+            result.stage_timestamps["received"] = received
+
+        if self.recorder is not None:
+            self.recorder.record(
+                frame.bgr_pixels, frame.timestamp_unix_seconds, [gaze], result
+            )
+        return result
+
+    def close(self, timeout: float = 5.0) -> None:
+        """Stop capturing and write the rest of the recording, if any"""
+        self._should_stop.set()
+        self.device.close()
+        if self._frame_thread is not None:
+            self._frame_thread.join(timeout)
+        if self.recorder is not None:
+            self.recorder.close()
+
+    def _process_frames(self) -> None:
+        # Only records the surface locations used by `map_gaze`
+        while not self._should_stop.is_set():
+            frame = self.device.receive_scene_video_frame()
+            self.metrics.observe_frame_timestamp(frame.timestamp_unix_seconds)
+            result = self.mapper.process_frame_columnar(
+                frame.bgr_pixels, frame_timestamp=frame.timestamp_unix_seconds
+            )
+            if self.recorder is not None:
+                self.recorder.record(
+                    frame.bgr_pixels, frame.timestamp_unix_seconds, [], result
+                )
+
+
+class MarkerMapperWorker(threading.Thread):
+    """Runs device capture and marker mapping on a dedicated thread.
+
+    Every non-empty result is handed to `publish` as soon as it is available, so the
+    output rate follows the scene camera instead of the consumer.
+    """
+
+    def __init__(
+        self,
+        mapper: MarkerMapper,
+        publish: Callable[["marker_mapper_lib.MarkerMapperResult"], None],
+    ) -> None:
+        super().__init__(name=f"MarkerMapperWorker-{mapper.device_id}", daemon=True)
+        self._mapper = mapper
+        self._publish = publish
+        self._should_stop = threading.Event()
+
+    def run(self) -> None:
+        try:
+            while not self._should_stop.is_set():
+                result = self._mapper()
+                if result is not None:
+                    self._publish(result)
+        finally:
+            self._mapper.close()
+
+    def stop(self) -> None:
+        self._should_stop.set()
+
+    def join_or_close(self, timeout: float) -> None:
+        """Wait for the worker to close its mapper, or close the mapper here.
+
+        The worker may stay blocked on the device, and as a daemon thread it does not
+        keep the process alive to finish the recording.
+        """
+        self.join(timeout)
+        if self.is_alive():
+            self._mapper.close(timeout)
+
+
+class ResultBroadcaster:
+    """Fans out mapper results to every subscribed consumer.
+
+    `publish` may be called from any thread. Each subscriber owns a bounded queue on
+    `loop`; when a subscriber falls behind, its oldest pending results are dropped so
+    a slow client never holds back the pipeline or the other clients.
+    """
+
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        max_pending: int = 8,
+        metrics: Optional[MarkerMapperMetrics] = None,
+    ) -> None:
+        self._loop = loop
+        self._max_pending = max_pending
+        self._metrics = metrics
+        self._subscribers: Set[asyncio.Queue] = set()
+
+    def publish(self, value: "marker_mapper_lib.MarkerMapperResult") -> None:
+        self._loop.call_soon_threadsafe(self._broadcast, value)
+
+    def _broadcast(self, value: "marker_mapper_lib.MarkerMapperResult") -> None:
+        for queue in self._subscribers:
+            if queue.full():
+                queue.get_nowait()
+                if self._metrics is not None:
+                    self._metrics.observe_dropped_results()
+            queue.put_nowait(value)
+
+    @contextlib.contextmanager
+    def subscribe(self) -> Iterator[asyncio.Queue]:
+        queue = asyncio.Queue(maxsize=self._max_pending)
+        self._subscribers.add(queue)
+        try:
+            yield queue
+        finally:
+            self._subscribers.discard(queue)
 
-        return result
\ No newline at end of file
+    @property
+    def subscriber_count(self) -> int:
+        return len(self._subscribers)
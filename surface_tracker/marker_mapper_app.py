@@ -1,19 +1,64 @@
-import cv2
+import threading
+from typing import Optional
 
 # from pupil_labs import surface_tracker
 from pupil_labs.realtime_api.simple import discover_one_device
 
-import marker_mapper_lib
-import utils_cloud_api
-from utils_visualization import (
-    draw_aoi,
-    draw_gaze_point,
-    draw_mapped_gaze_point,
-    draw_marker_outlines,
-)
+from marker_mapper import SURFACE_DEFINITIONS_PATH
+from utils_startup import preload_pipeline
+
+
+class CaptureThread(threading.Thread):
+    """Receives and maps scene frames independently of the display.
+
+    Only the most recent result is kept; results that were replaced before the
+    display picked them up are counted in `skipped_frames`.
+    """
+
+    def __init__(self, device, mapper) -> None:
+        super().__init__(name="CaptureThread", daemon=True)
+        self._device = device
+        self._mapper = mapper
+        self._latest: Optional[tuple] = None
+        self._has_latest = threading.Condition()
+        self._should_stop = threading.Event()
+        self.skipped_frames = 0
+
+    def run(self) -> None:
+        while not self._should_stop.is_set():
+            # Wait for scene camera image and corresponding gaze position
+            frame, gaze = self._device.receive_matched_scene_video_frame_and_gaze()
+
+            # Process frame and gaze
+            # 1. Marker detection
+            # 2. AoI localisation
+            # 3. Mapping gaze to AoI
+            result = self._mapper.process_frame(frame.bgr_pixels, [gaze])
+
+            if result is None:
+                continue
+
+            with self._has_latest:
+                if self._latest is not None:
+                    self.skipped_frames += 1
+                self._latest = (frame, gaze, result)
+                self._has_latest.notify()
+
+    def take_latest(self, timeout: float) -> Optional[tuple]:
+        """Return the most recent (frame, gaze, result) not yet taken, if any"""
+        with self._has_latest:
+            self._has_latest.wait_for(lambda: self._latest is not None, timeout)
+            latest, self._latest = self._latest, None
+        return latest
+
+    def stop(self) -> None:
+        self._should_stop.set()
 
 
 def main():
+    # Load the heavy dependencies and surfaces while looking for the device
+    surfaces = preload_pipeline(SURFACE_DEFINITIONS_PATH)
+
     # Look for devices. Returns as soon as it has found the first device.
     print("Looking for the next best device...")
     device = discover_one_device(max_search_duration_seconds=10)
@@ -21,6 +66,7 @@ def main():
         print("No device found.")
         raise SystemExit(-1)
 
+    capture = None
     try:
         # Pull scene camera serial to fetch accurate camera intrinsics
         serial_number_scene_cam = device.serial_number_scene_cam
@@ -29,12 +75,17 @@ def main():
             device.close()
             raise SystemExit(-2)
 
+        surfaces = surfaces.result()
+        import cv2
+
+        import marker_mapper_lib
+        import utils_cloud_api
+        from utils_visualization import MonitorRenderer
+
         # Setup area of interest (AoI) tracking
         camera = utils_cloud_api.camera_for_scene_cam_serial(serial_number_scene_cam)
-        mapper = marker_mapper_lib.MarkerMapper(camera)
-        mapper.add_core_surface_definitions_from_file(
-            "~/pupil_capture_settings/surface_definitions_v01"
-        )
+        mapper = marker_mapper_lib.MarkerMapper(camera, surfaces=surfaces)
+        mapper.warm_up()
         surface_uid_by_name = {s.name: s.uid for s in mapper.surfaces}
 
         # Load reference images
@@ -52,42 +103,27 @@ def main():
             cv2.moveWindow(name, screen_position, 50)
             screen_position += ref_img.shape[1] + 50
 
-        # Main event loop:
-        while True:
-            # Wait for scene camera image and corresponding gaze position
-            frame, gaze = device.receive_matched_scene_video_frame_and_gaze()
-
-            # Process frame and gaze
-            # 1. Marker detection
-            # 2. AoI localisation
-            # 3. Mapping gaze to AoI
-            result = mapper.process_frame(frame.bgr_pixels, [gaze])
-
-            if result is None:
-                continue
-
-            # Draw detected markers
-            draw_marker_outlines(frame.bgr_pixels, result.markers, camera=camera)
+        # Capture and mapping never wait for the display. HighGUI windows have to be
+        # served from the main thread, so rendering stays here.
+        capture = CaptureThread(device, mapper)
+        capture.start()
+        renderer = MonitorRenderer(camera)
 
-            # Draw localised surfaces (fill if gaze is on AoI)
-            for aoi_id, location in result.located_aois.items():
-                if location is None:
-                    continue
-                any_gaze_on_aoi = any(g.is_on_aoi for g in result.mapped_gaze[aoi_id])
-                draw_aoi(
-                    frame.bgr_pixels, location, camera=camera, fill=any_gaze_on_aoi
+        # Main event loop:
+        while capture.is_alive():
+            latest = capture.take_latest(timeout=0.05)
+            if latest is not None:
+                frame, gaze, result = latest
+
+                # Draw detected markers, localised surfaces and gaze
+                cv2.imshow(
+                    main_title, renderer.draw_scene(frame.bgr_pixels, result, gaze)
                 )
 
-            # Draw gaze and display main window
-            draw_gaze_point(frame.bgr_pixels, gaze)
-            cv2.imshow(main_title, frame.bgr_pixels)
-
-            # Draw AoI-mapped gaze and display reference image
-            for name, img in areas_of_interest.items():
-                for gaze in result.mapped_gaze[surface_uid_by_name[name]]:
-                    if gaze.is_on_aoi:
-                        img = draw_mapped_gaze_point(img, gaze)
-                cv2.imshow(name, img)
+                # Draw AoI-mapped gaze and display reference image
+                for name, img in areas_of_interest.items():
+                    mapped_gaze = result.mapped_gaze[surface_uid_by_name[name]]
+                    cv2.imshow(name, renderer.draw_reference(name, img, mapped_gaze))
 
             pressed_key = cv2.waitKey(1)
             if pressed_key == 27:  # ESC
@@ -96,6 +132,9 @@ def main():
         pass
     finally:
         print("Stopping...")
+        if capture is not None:
+            capture.stop()
+            print(f"Skipped drawing {capture.skipped_frames} frames")
         device.close()  # explicitly stop auto-update
 
 
@@ -0,0 +1,279 @@
+"""Asyncio-native device ingest for the marker mapper.
+
+Scene video and gaze are received as separate streams with the async realtime API
+and matched by timestamp, so that every gaze sample is mapped together with the scene
+frame it belongs to instead of only the closest one. Discovery, (re)connection and
+matching run on the event loop; only the marker mapping runs on a worker thread.
+"""
+import asyncio
+import concurrent.futures
+import logging
+import time
+from typing import Any, AsyncIterator, Callable, Iterable, List, Optional
+
+import numpy as np
+import numpy.typing as npt
+from pupil_labs.realtime_api import (
+    Device,
+    GazeData,
+    Network,
+    receive_gaze_data,
+    receive_video_frames,
+)
+from pupil_labs.realtime_api.models import Status
+from pupil_labs.realtime_api.streaming import VideoFrame
+
+from marker_mapper import create_mapper
+from utils_metrics import MarkerMapperMetrics
+
+# Seconds to wait before reconnecting a stream that failed
+RECONNECT_DELAY = 1.0
+
+
+async def discover_devices(
+    max_devices: int = 1, search_duration_seconds: float = 10
+) -> List[Device]:
+    """Up to `max_devices` devices, returned as soon as they were found"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + search_duration_seconds
+    devices = []
+    async with Network() as network:
+        while len(devices) < max_devices:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            device_info = await network.wait_for_new_device(timeout_seconds=remaining)
+            if device_info is None:
+                break
+            devices.append(Device.from_discovered_device(device_info))
+    return devices
+
+
+class GazeRingBuffer:
+    """The most recent `capacity` gaze samples, indexed by timestamp.
+
+    Samples are expected in timestamp order; older or repeated samples are dropped.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self._timestamps = np.full(capacity, -np.inf, dtype=np.float64)
+        self._samples: List[Optional[GazeData]] = [None] * capacity
+        self._count = 0
+
+    def __len__(self) -> int:
+        return min(self._count, len(self._samples))
+
+    @property
+    def newest_timestamp(self) -> float:
+        if not self._count:
+            return -np.inf
+        return float(self._timestamps[(self._count - 1) % len(self._samples)])
+
+    def append(self, sample: GazeData) -> bool:
+        timestamp = sample.timestamp_unix_seconds
+        if timestamp <= self.newest_timestamp:
+            return False
+        index = self._count % len(self._samples)
+        self._timestamps[index] = timestamp
+        self._samples[index] = sample
+        self._count += 1
+        return True
+
+    def between(self, start: float, stop: float) -> List[GazeData]:
+        """Samples with `start < timestamp <= stop`, oldest first"""
+        capacity = len(self._samples)
+        order = (self._count - len(self) + np.arange(len(self))) % capacity
+        timestamps: npt.NDArray[np.float64] = self._timestamps[order]
+        first, last = np.searchsorted(timestamps, (start, stop), side="right")
+        return [self._samples[index] for index in order[first:last]]
+
+
+class FrameGazeMatcher:
+    """Assigns buffered gaze samples to scene frames by timestamp.
+
+    A frame receives every sample within `tolerance` seconds of its timestamp that was
+    not assigned to an earlier frame. With the default of half a scene frame period,
+    every sample goes to its closest frame. Since gaze may arrive after the frame, a
+    frame is matched once gaze past its window arrived, or after `max_wait` seconds;
+    samples arriving later than that are dropped.
+    """
+
+    def __init__(
+        self, tolerance: float = 1 / 60, max_wait: float = 0.1, capacity: int = 1024
+    ):
+        self.gaze = GazeRingBuffer(capacity)
+        self._tolerance = tolerance
+        self._max_wait = max_wait
+        self._assigned_until = -np.inf
+        self._gaze_arrived = asyncio.Event()
+
+    def add_gaze(self, sample: GazeData) -> None:
+        if self.gaze.append(sample):
+            self._gaze_arrived.set()
+
+    async def match(self, frame_timestamp: float) -> List[GazeData]:
+        stop = frame_timestamp + self._tolerance
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self._max_wait
+        while self.gaze.newest_timestamp <= stop:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            self._gaze_arrived.clear()
+            try:
+                await asyncio.wait_for(self._gaze_arrived.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+
+        start = max(frame_timestamp - self._tolerance, self._assigned_until)
+        self._assigned_until = max(stop, self._assigned_until)
+        return self.gaze.between(start, stop)
+
+
+class AsyncMarkerMapper:
+    """Streams one device on the event loop and maps its frames on a worker thread.
+
+    Create with `connect()` and run with `run()`; exposes the same `device_id`,
+    `metrics` and `describe()` as `marker_mapper.MarkerMapper`.
+    """
+
+    def __init__(
+        self,
+        device: Device,
+        status: Status,
+        mapper: "marker_mapper_lib.MarkerMapper",
+        metrics: MarkerMapperMetrics,
+        matcher: FrameGazeMatcher,
+        recorder: Optional["session_recorder.SessionRecorder"] = None,
+        max_pending_frames: int = 2,
+    ):
+        self.device = device
+        self.device_id = status.phone.device_id
+        self.metrics = metrics
+        self.mapper = mapper
+        self.matcher = matcher
+        self.recorder = recorder
+        self._status = status
+        self._frames: asyncio.Queue = asyncio.Queue(maxsize=max_pending_frames)
+        # A single thread keeps the frames in order for stateful detector options
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix=f"MarkerMapper-{self.device_id}"
+        )
+
+    @staticmethod
+    async def connect(
+        device: Device,
+        surfaces: Iterable["marker_mapper_lib.Surface"],
+        record_to: Optional[str] = None,
+        tolerance: float = 1 / 60,
+        max_wait: float = 0.1,
+        smooth_gaze: bool = False,
+    ) -> "AsyncMarkerMapper":
+        import utils_cloud_api
+
+        status = await device.get_status()
+        serial_number_scene_cam = status.hardware.world_camera_serial
+        if serial_number_scene_cam in ("", "unknown", "default"):
+            await device.close()
+            raise ConnectionError(
+                f"Scene camera of {status.phone.device_name} not connected"
+            )
+
+        # Fetching intrinsics and building the undistortion tables may block
+        loop = asyncio.get_running_loop()
+        camera = await loop.run_in_executor(
+            None, utils_cloud_api.camera_for_scene_cam_serial, serial_number_scene_cam
+        )
+        metrics = MarkerMapperMetrics()
+        mapper = create_mapper(camera, surfaces, metrics, smooth_gaze)
+        await loop.run_in_executor(None, mapper.warm_up)
+
+        recorder = None
+        if record_to is not None:
+            from session_recorder import SessionRecorder
+
+            recorder = SessionRecorder(
+                record_to, camera, surfaces, metrics=metrics, smooth_gaze=smooth_gaze
+            )
+        matcher = FrameGazeMatcher(tolerance=tolerance, max_wait=max_wait)
+        return AsyncMarkerMapper(device, status, mapper, metrics, matcher, recorder)
+
+    def describe(self) -> dict:
+        return {
+            "id": self.device_id,
+            "name": self._status.phone.device_name,
+            "scene_camera": self._status.hardware.world_camera_serial,
+        }
+
+    async def run(
+        self, publish: Callable[["marker_mapper_lib.MarkerMapperResult"], None]
+    ) -> None:
+        receivers = [
+            asyncio.ensure_future(
+                self._receive("direct_gaze_sensor", receive_gaze_data, self._add_gaze)
+            ),
+            asyncio.ensure_future(
+                self._receive(
+                    "direct_world_sensor", receive_video_frames, self._add_frame
+                )
+            ),
+        ]
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                frame, received = await self._frames.get()
+                gaze = await self.matcher.match(frame.timestamp_unix_seconds)
+                self.metrics.observe_frame_timestamp(frame.timestamp_unix_seconds)
+                result = await loop.run_in_executor(
+                    self._executor, self._process_frame, frame, gaze
+                )
+                if result is not None:
+                    result.stage_timestamps["received"] = received
+                    publish(result)
+        finally:
+            for receiver in receivers:
+                receiver.cancel()
+            self._executor.shutdown(wait=False)
+            if self.recorder is not None:
+                self.recorder.close()
+            await self.device.close()
+
+    def _process_frame(
+        self, frame: VideoFrame, gaze: List[GazeData]
+    ) -> Optional["marker_mapper_lib.MarkerMapperResult"]:
+        image = frame.bgr_buffer()
+        result = self.mapper.process_frame(image, gaze)
+        if self.recorder is not None:
+            self.recorder.record(image, frame.timestamp_unix_seconds, gaze, result)
+        return result
+
+    def _add_gaze(self, sample: GazeData) -> None:
+        self.matcher.add_gaze(sample)
+
+    def _add_frame(self, frame: VideoFrame) -> None:
+        # Keep the newest frames when mapping falls behind
+        if self._frames.full():
+            self._frames.get_nowait()
+        self._frames.put_nowait((frame, time.time()))
+
+    async def _receive(
+        self,
+        sensor_name: str,
+        receive: Callable[..., AsyncIterator[Any]],
+        handle: Callable[[Any], None],
+    ) -> None:
+        while True:
+            try:
+                status = await self.device.get_status()
+                sensor = getattr(status, sensor_name)()
+                if not sensor.connected:
+                    raise ConnectionError("sensor not connected")
+                async for item in receive(
+                    sensor.url, run_loop=True, log_level=logging.WARNING
+                ):
+                    handle(item)
+            except Exception as err:
+                logging.warning(
+                    f"{self.device_id}: {sensor_name} stream lost ({err}), reconnecting"
+                )
+            await asyncio.sleep(RECONNECT_DELAY)
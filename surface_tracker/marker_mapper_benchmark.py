@@ -0,0 +1,447 @@
+"""Synthetic benchmark for the marker mapping hot path.
+
+Renders marker boards, warps them into a distorted scene camera image with random
+homographies, adds blur and noise and times each stage of `MarkerMapper.process_frame`.
+Since the ground-truth homographies are known, mapped gaze accuracy is reported next to
+the timings. One JSON object is written per configuration, so that results of different
+commits can be compared:
+
+    python marker_mapper_benchmark.py --output bench.jsonl
+    python marker_mapper_benchmark.py --resolutions 1088x1080 1600x1200 \\
+        --layouts keyboard border:10x5 --surface-counts 1 8
+"""
+import argparse
+import datetime
+import gc
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+import numpy.typing as npt
+import pupil_apriltags
+from pupil_labs.realtime_api import GazeData
+from pupil_labs.surface_tracker import CoordinateSpace, CornerId, SurfaceOrientation
+
+import marker_mapper_lib
+import utils_cloud_api
+from create_marker_background import get_marker_coordinates
+from marker_mapper_lib import _CoreMarker, _CoreSurface
+from utils_metrics import MarkerMapperMetrics
+
+DEFAULT_MARKERS_DIR = os.path.join(
+    os.path.dirname(__file__), "..", "client", "public", "markers_resized"
+)
+BOARD_RESOLUTION = (1920, 1080)
+
+# Marker cells of the `KeyMarkerBoard` grid (7 columns) in client/src/components
+KEYBOARD_COLUMNS = 7
+KEYBOARD_ROWS = 6
+KEYBOARD_MARKER_CELLS = (0, 6, 8, 12, 14, 20, 24, 28, 34)
+
+
+class SyntheticFrame(NamedTuple):
+    image: npt.NDArray[np.uint8]
+    gaze: List[GazeData]
+    # Ground-truth normalized gaze position per surface uid, Nx2
+    expected_gaze: Dict[str, npt.NDArray[np.float64]]
+
+
+class Board(NamedTuple):
+    image: npt.NDArray[np.uint8]
+    surfaces: List[_CoreSurface]
+    # Surface rectangles (x0, y0, x1, y1) in board pixels by surface uid
+    surface_rects: Dict[str, Tuple[float, float, float, float]]
+    marker_count: int
+
+
+def load_marker_images(markers_dir: str, count: int) -> List[npt.NDArray[np.uint8]]:
+    names = [f"tag36_11_{str(i).zfill(5)}.png" for i in range(count)]
+    images = [cv2.imread(os.path.join(markers_dir, name)) for name in names]
+    if any(img is None for img in images):
+        raise FileNotFoundError(f"Could not load {count} markers from {markers_dir}")
+    return images
+
+
+def border_layout(
+    horizontal_slots: int, vertical_slots: int
+) -> Tuple[npt.NDArray[np.int32], int]:
+    marker_size = min(BOARD_RESOLUTION) // max(vertical_slots + 1, 4)
+    positions = get_marker_coordinates(
+        horizontal_slots, vertical_slots, BOARD_RESOLUTION, marker_size
+    )
+    return positions, marker_size
+
+
+def keyboard_layout() -> Tuple[npt.NDArray[np.int32], int]:
+    cell_w = BOARD_RESOLUTION[0] / KEYBOARD_COLUMNS
+    cell_h = BOARD_RESOLUTION[1] / KEYBOARD_ROWS
+    marker_size = int(min(cell_w, cell_h))
+    positions = [
+        (
+            (cell % KEYBOARD_COLUMNS) * cell_w + (cell_w - marker_size) / 2,
+            (cell // KEYBOARD_COLUMNS) * cell_h + (cell_h - marker_size) / 2,
+        )
+        for cell in KEYBOARD_MARKER_CELLS
+    ]
+    return np.array(positions, dtype=np.int32), marker_size
+
+
+def render_board(
+    layout: str, surface_count: int, markers_dir: str, rng: np.random.Generator
+) -> Board:
+    if layout == "keyboard":
+        positions, marker_size = keyboard_layout()
+    else:
+        horizontal_slots, vertical_slots = map(int, layout.split(":")[1].split("x"))
+        positions, marker_size = border_layout(horizontal_slots, vertical_slots)
+
+    image = np.full((BOARD_RESOLUTION[1], BOARD_RESOLUTION[0], 3), 255, np.uint8)
+    marker_images = load_marker_images(markers_dir, len(positions))
+    for (x, y), marker_img in zip(positions, marker_images):
+        marker_img = cv2.resize(
+            marker_img, (marker_size, marker_size), interpolation=cv2.INTER_NEAREST
+        )
+        image[y : y + marker_size, x : x + marker_size] = marker_img
+
+    # Register the markers as detected on the flat board, like Pupil Capture does
+    detector = pupil_apriltags.Detector(families="tag36h11")
+    detections = detector.detect(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY))
+    corners_by_uid = {
+        marker_mapper_lib.create_apriltag_marker_uid(
+            d.tag_family.decode("utf-8"), int(d.tag_id)
+        ): d.corners
+        for d in detections
+    }
+
+    width, height = BOARD_RESOLUTION
+    surface_rects = {}
+    surfaces = []
+    for index in range(surface_count):
+        if index == 0:
+            rect = (0.0, 0.0, float(width), float(height))
+        else:
+            x0, x1 = np.sort(rng.uniform(0, width, 2))
+            y0, y1 = np.sort(rng.uniform(0, height, 2))
+            rect = (x0, y0, max(x1, x0 + 50), max(y1, y0 + 50))
+        uid = f"surface-{index}"
+        registered_markers = {
+            marker_uid: _CoreMarker(
+                uid=marker_uid,
+                coordinate_space=CoordinateSpace.SURFACE_UNDISTORTED,
+                vertices_by_corner_id=dict(
+                    zip(CornerId, _board_to_surface(corners, rect).tolist())
+                ),
+            )
+            for marker_uid, corners in corners_by_uid.items()
+        }
+        surfaces.append(
+            _CoreSurface(
+                uid=uid,
+                name=uid,
+                registered_markers_undistorted=registered_markers,
+                orientation=SurfaceOrientation(),
+            )
+        )
+        surface_rects[uid] = rect
+    return Board(image, surfaces, surface_rects, len(corners_by_uid))
+
+
+def render_frame(
+    board: Board,
+    camera: marker_mapper_lib.RadialDistorsionCamera,
+    resolution: Tuple[int, int],
+    rng: np.random.Generator,
+    gaze_count: int = 4,
+    blur_sigma: float = 1.0,
+    noise_sigma: float = 4.0,
+) -> SyntheticFrame:
+    width, height = resolution
+    board_h, board_w = board.image.shape[:2]
+
+    # Random homography: board scaled into the frame, rotated and perspectively skewed
+    scale = rng.uniform(0.5, 0.85) * min(width / board_w, height / board_h)
+    angle = np.deg2rad(rng.uniform(-15, 15))
+    rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    board_corners = np.array(
+        [[0, 0], [board_w, 0], [board_w, board_h], [0, board_h]], dtype=np.float64
+    )
+    centered = (board_corners - (board_w / 2, board_h / 2)) * scale
+    center = (width / 2, height / 2) + rng.uniform(-0.05, 0.05, 2) * (width, height)
+    jitter = rng.uniform(-0.04, 0.04, (4, 2)) * scale * (board_w, board_h)
+    scene_corners = centered @ rotation.T + center + jitter
+    H = cv2.getPerspectiveTransform(
+        board_corners.astype(np.float32), scene_corners.astype(np.float32)
+    )
+
+    undistorted = cv2.warpPerspective(
+        board.image, H, (width, height), borderValue=(128, 128, 128)
+    )
+    image = cv2.remap(undistorted, *_distortion_maps(camera, resolution), cv2.INTER_LINEAR)
+    if blur_sigma > 0:
+        image = cv2.GaussianBlur(image, (0, 0), blur_sigma)
+    if noise_sigma > 0:
+        noise = rng.normal(0, noise_sigma, image.shape)
+        image = np.clip(image + noise, 0, 255).astype(np.uint8)
+
+    # Ground-truth gaze: random board points projected through H and the distortion
+    gaze_board = rng.uniform(0.1, 0.9, (gaze_count, 2)) * (board_w, board_h)
+    gaze_scene = cv2.perspectiveTransform(gaze_board.reshape((-1, 1, 2)), H)
+    gaze_scene = camera.distort_points_on_image_plane(gaze_scene)
+    now = time.time()
+    gaze = [
+        GazeData(x=x, y=y, worn=True, timestamp_unix_seconds=now)
+        for x, y in gaze_scene.tolist()
+    ]
+    expected_gaze = {
+        uid: _board_to_surface(gaze_board, rect)
+        for uid, rect in board.surface_rects.items()
+    }
+    return SyntheticFrame(image, gaze, expected_gaze)
+
+
+def run_configuration(
+    resolution: Tuple[int, int],
+    layout: str,
+    surface_count: int,
+    args: argparse.Namespace,
+) -> dict:
+    rng = np.random.default_rng(args.seed)
+    camera = _camera_for_resolution(resolution, args.intrinsics)
+    board = render_board(layout, surface_count, args.markers_dir, rng)
+    frames = [
+        render_frame(
+            board,
+            camera,
+            resolution,
+            rng,
+            blur_sigma=args.blur,
+            noise_sigma=args.noise,
+        )
+        for _ in range(args.frames)
+    ]
+
+    mapper = marker_mapper_lib.MarkerMapper(
+        camera, board.surfaces, reuse_buffers=args.reuse_buffers
+    )
+    for frame in frames[: args.warmup]:
+        mapper.process_frame(frame.image, frame.gaze)
+
+    # Stage timings are recorded by the mapper's built-in instrumentation
+    mapper.metrics = MarkerMapperMetrics(window=args.repeat * len(frames))
+    errors: List[float] = []
+    detected_markers: List[int] = []
+    located = 0
+    for _ in range(args.repeat):
+        for frame in frames:
+            result = mapper.process_frame(frame.image, frame.gaze)
+            detected_markers.append(len(result.markers))
+            for uid, location in result.located_aois.items():
+                if location is None:
+                    continue
+                located += 1
+                mapped = np.array([(g.x, g.y) for g in result.mapped_gaze[uid]])
+                errors.extend(
+                    np.linalg.norm(mapped - frame.expected_gaze[uid], axis=1).tolist()
+                )
+
+    allocations = None
+    if args.trace_allocations:
+        allocations = measure_allocations(mapper, frames)
+
+    attempts = args.repeat * len(frames) * surface_count
+    return {
+        "resolution": f"{resolution[0]}x{resolution[1]}",
+        "layout": layout,
+        "markers": board.marker_count,
+        "surfaces": surface_count,
+        "frames": len(frames) * args.repeat,
+        "timings_ms": {
+            stage: {
+                "median": float(np.median(histogram.recent()) * 1e3),
+                "p90": float(np.percentile(histogram.recent(), 90) * 1e3),
+                "mean": float(np.mean(histogram.recent()) * 1e3),
+            }
+            for stage, histogram in mapper.metrics.stage_latency.items()
+        },
+        "detected_markers_mean": float(np.mean(detected_markers)),
+        "surface_located_rate": located / attempts if attempts else 0.0,
+        "gaze_error_norm": {
+            "median": float(np.median(errors)) if errors else None,
+            "p90": float(np.percentile(errors, 90)) if errors else None,
+            "max": float(np.max(errors)) if errors else None,
+        },
+        "allocations": allocations,
+    }
+
+
+def measure_allocations(
+    mapper: marker_mapper_lib.MarkerMapper, frames: Sequence[SyntheticFrame]
+) -> dict:
+    """Trace the memory allocated by `process_frame_columnar` in steady state.
+
+    Reports the bytes still held after each frame once its result was released,
+    the transient peak per frame and the garbage collections per frame.
+    """
+    gaze = [marker_mapper_lib.GazeColumns.from_gaze_data(f.gaze) for f in frames]
+    retained, peaks = [], []
+    tracemalloc.start()
+    try:
+        # The first pass sizes reused buffers and caches
+        for frame, frame_gaze in zip(frames, gaze):
+            mapper.process_frame_columnar(frame.image, frame_gaze)
+        collections_before = sum(stats["collections"] for stats in gc.get_stats())
+        for frame, frame_gaze in zip(frames, gaze):
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            result = mapper.process_frame_columnar(frame.image, frame_gaze)
+            _, peak = tracemalloc.get_traced_memory()
+            del result
+            after, _ = tracemalloc.get_traced_memory()
+            retained.append(after - before)
+            peaks.append(peak - before)
+        collections = sum(stats["collections"] for stats in gc.get_stats())
+    finally:
+        tracemalloc.stop()
+    return {
+        "retained_bytes_per_frame": float(np.mean(retained)),
+        "peak_bytes_per_frame": float(np.median(peaks)),
+        "gc_collections_per_frame": (collections - collections_before) / len(frames),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--resolutions", nargs="+", default=["1088x1080"], help="scene WIDTHxHEIGHT"
+    )
+    parser.add_argument(
+        "--layouts",
+        nargs="+",
+        default=["keyboard", "border:10x5"],
+        help="`keyboard` or `border:<horizontal>x<vertical>` marker slots",
+    )
+    parser.add_argument("--surface-counts", nargs="+", type=int, default=[1, 4])
+    parser.add_argument("--frames", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--blur", type=float, default=1.0)
+    parser.add_argument("--noise", type=float, default=4.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--markers-dir", default=DEFAULT_MARKERS_DIR)
+    parser.add_argument(
+        "--intrinsics", help="intrinsics.<serial>.json to use instead of a default model"
+    )
+    parser.add_argument("--output", help="append results to this JSON lines file")
+    parser.add_argument(
+        "--reuse-buffers",
+        action="store_true",
+        help="run the mapper with preallocated, reused frame buffers",
+    )
+    parser.add_argument(
+        "--trace-allocations",
+        action="store_true",
+        help="trace steady-state memory allocations per frame (Python 3.9+)",
+    )
+    parser.add_argument(
+        "--max-retained-bytes",
+        type=float,
+        help="fail if more bytes than this are retained per frame, implies "
+        "--trace-allocations",
+    )
+    args = parser.parse_args()
+    if args.max_retained_bytes is not None:
+        args.trace_allocations = True
+
+    metadata = {
+        "commit": _git_commit(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "opencv": cv2.__version__,
+    }
+    output = open(args.output, "a") if args.output else sys.stdout
+    exceeded = []
+    try:
+        for resolution in args.resolutions:
+            resolution = tuple(map(int, resolution.split("x")))
+            for layout in args.layouts:
+                for surface_count in args.surface_counts:
+                    result = run_configuration(resolution, layout, surface_count, args)
+                    print(json.dumps({**metadata, **result}), file=output, flush=True)
+                    if _exceeds_allocation_limit(result, args.max_retained_bytes):
+                        exceeded.append(result)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    if exceeded:
+        for result in exceeded:
+            retained = result["allocations"]["retained_bytes_per_frame"]
+            print(
+                f"{result['resolution']} {result['layout']} "
+                f"{result['surfaces']} surface(s): {retained:.0f} bytes retained per "
+                f"frame, limit is {args.max_retained_bytes:.0f}",
+                file=sys.stderr,
+            )
+        raise SystemExit(1)
+
+
+def _exceeds_allocation_limit(result: dict, limit: Optional[float]) -> bool:
+    if limit is None:
+        return False
+    return result["allocations"]["retained_bytes_per_frame"] > limit
+
+
+def _board_to_surface(
+    points: npt.NDArray[np.float64], rect: Tuple[float, float, float, float]
+) -> npt.NDArray[np.float64]:
+    # Surface coordinates are normalized to the surface rect, with the y-axis up
+    x0, y0, x1, y1 = rect
+    points = np.asarray(points, dtype=np.float64).reshape((-1, 2))
+    u = (points[:, 0] - x0) / (x1 - x0)
+    v = 1.0 - (points[:, 1] - y0) / (y1 - y0)
+    return np.stack((u, v), axis=1)
+
+
+def _camera_for_resolution(
+    resolution: Tuple[int, int], intrinsics_path: Optional[str]
+) -> marker_mapper_lib.RadialDistorsionCamera:
+    if intrinsics_path:
+        return utils_cloud_api.camera_from_intrinsics_file(intrinsics_path)
+    width, height = resolution
+    focal_length = 0.7 * width
+    return marker_mapper_lib.RadialDistorsionCamera(
+        K=[[focal_length, 0, width / 2], [0, focal_length, height / 2], [0, 0, 1]],
+        D=[[-0.13, 0.11, 0.0, 0.0, -0.04]],
+    )
+
+
+def _distortion_maps(
+    camera: marker_mapper_lib.RadialDistorsionCamera, resolution: Tuple[int, int]
+) -> Sequence[npt.NDArray[np.float32]]:
+    # For every distorted pixel, look up where it lies in the undistorted image
+    width, height = resolution
+    grid = np.mgrid[0:height, 0:width][::-1].reshape((2, -1)).T.astype(np.float64)
+    undistorted = camera.undistort_points_on_image_plane(grid).astype(np.float32)
+    undistorted = undistorted.reshape((height, width, 2))
+    return undistorted[..., 0].copy(), undistorted[..., 1].copy()
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    main()
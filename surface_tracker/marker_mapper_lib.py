@@ -1,7 +1,23 @@
+import hashlib
+import logging
 import os
+import pickle
 import sys
+import threading
+import time
 import uuid
-from typing import Dict, Iterable, List, Mapping, NamedTuple, Optional, Tuple
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
 
 if sys.version_info < (3, 8):
     from typing_extensions import TypedDict
@@ -27,20 +43,52 @@ from pupil_labs.surface_tracker import (
     marker,
 )
 
+from gaze_filters import GazeFilterStage
+from utils_metrics import MarkerMapperMetrics
+
 
 class MarkerMapper:
     def __init__(
         self,
         camera: Optional["RadialDistorsionCamera"],
         surfaces: Iterable[Surface] = (),
+        flow_tracker: Optional["MarkerFlowTracker"] = None,
+        metrics: Optional[MarkerMapperMetrics] = None,
+        gaze_filter: Optional[GazeFilterStage] = None,
+        reuse_buffers: bool = False,
+        **detector_options,
     ) -> None:
+        """
+        :param flow_tracker: If set, markers are propagated between frames with
+            optical flow and the detector only runs when the tracker requests it
+        :param metrics: If set, per-stage timings and detection statistics of every
+            processed frame are recorded into it
+        :param gaze_filter: If set, mapped gaze is filtered per surface before it is
+            returned
+        :param reuse_buffers: Write the gray image and the undistorted points into
+            buffers that are sized from the first frame and reused for every
+            following frame, instead of allocating them per frame
+        :param detector_options: Passed on to the `ApriltagDetector`, e.g.
+            `roi_tracking=True`
+        """
         self._camera: Optional[RadialDistorsionCamera]
         self._detector: Optional[ApriltagDetector]
+        self._detector_options = detector_options
+        self._flow_tracker = flow_tracker
         self._tracker = SurfaceTracker()
+        self.metrics = metrics
+        self._gaze_filter = gaze_filter
+        self._buffers = _FrameBuffers() if reuse_buffers else None
+        self._surfaces: List[Surface] = list(surfaces)
+        self._surface_uids = tuple(surface.uid for surface in self._surfaces)
+        self._surface_index = SurfaceMarkerIndex(self._surfaces)
 
         self.camera = camera
-        self._surfaces: List[Surface] = list(surfaces)
         self._recent_result: Optional[MarkerMapperResult] = None
+        self._location_history = SurfaceLocationHistory()
+        # Held by `map_gaze` so that gaze is never mapped with the camera grid of one
+        # resolution and the surface locations of another
+        self._image_size_lock = threading.Lock()
 
     def process_frame(
         self, frame: npt.NDArray[np.uint8], gaze: Iterable[GazeData] = ()
@@ -48,70 +96,315 @@ class MarkerMapper:
         """
         1. Detect markers
         2. Locate defined surfaces
-        3. (Optional) Map gaze to each located surface
+        3. (Optional) Map gaze to each located surface and filter it
+        """
+        gaze = list(gaze)
+        result = self.process_frame_columnar(
+            frame, GazeColumns.from_gaze_data(gaze), base_data=gaze
+        )
+        if result is None:
+            return None
+        return result.to_result()
+
+    def process_frame_columnar(
+        self,
+        frame: npt.NDArray[np.uint8],
+        gaze: Optional["GazeColumns"] = None,
+        base_data: Optional[Sequence[GazeData]] = None,
+        frame_timestamp: Optional[float] = None,
+    ) -> Optional["ColumnarMarkerMapperResult"]:
+        """Like `process_frame`, but with gaze columns in and out.
+
+        :param base_data: `GazeData` samples matching `gaze`, returned as
+            `base_datum` of the `MarkerMappedGaze` view of the result. Built from
+            `gaze` on access if not given.
+        :param frame_timestamp: If set, the surface locations are recorded for
+            `map_gaze`
         """
         if not all((self._camera, self._detector)):
             return
+        if gaze is None:
+            gaze = GazeColumns.empty()
 
+        t_start = time.perf_counter()
+        wall_start = time.time()
+        if self._camera.image_size != (frame.shape[1], frame.shape[0]):
+            self._set_image_size((frame.shape[1], frame.shape[0]))
         is_gray = (frame.ndim == 2) or (frame.shape[2] == 1)
         if is_gray:
-            markers = self._detector.detect_from_gray(frame)
+            gray = frame.reshape(frame.shape[:2])
         else:
-            markers = self._detector.detect_from_image(frame)
+            dst = None if self._buffers is None else self._buffers.gray(frame.shape)
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=dst)
+        t_gray = time.perf_counter()
+
+        corners_by_uid = None
+        if self._flow_tracker is not None:
+            corners_by_uid = self._flow_tracker.track(gray)
+            if corners_by_uid is not None:
+                self._detector.update_tracked_corners(corners_by_uid)
+        if corners_by_uid is None:
+            corners_by_uid = self._detector.detect_corners_from_gray(gray)
+            if self._flow_tracker is not None:
+                self._flow_tracker.set_keyframe(gray, corners_by_uid)
+        t_detect = time.perf_counter()
+
+        # Undistort marker corners and gaze in a single batch
+        num_corners = 4 * len(corners_by_uid)
+        if self._buffers is None:
+            corners = np.reshape(list(corners_by_uid.values()), (-1, 2))
+            gaze_points = np.column_stack((gaze.x, gaze.y))
+            undistorted = self._camera.undistort_points_on_image_plane(
+                np.concatenate((corners, gaze_points))
+            )
+            corners_undistorted = undistorted[:num_corners]
+        else:
+            points, undistorted = self._buffers.points(num_corners + len(gaze.x))
+            for index, marker_corners in enumerate(corners_by_uid.values()):
+                points[4 * index : 4 * index + 4] = marker_corners
+            points[num_corners:, 0] = gaze.x
+            points[num_corners:, 1] = gaze.y
+            self._camera.undistort_points_on_image_plane(points, out=undistorted)
+            # Markers keep references to their vertices beyond this frame
+            corners_undistorted = undistorted[:num_corners].copy()
+        markers = self._detector.markers_from_undistorted_corners(
+            corners_by_uid.keys(), corners_undistorted
+        )
+        gaze_undistorted = undistorted[num_corners:]
+        t_undistort = time.perf_counter()
 
-        surface_locations = {
-            surface.uid: self._tracker.locate_surface(
+        # Only evaluate surfaces with enough of their registered markers in view
+        surface_locations = dict.fromkeys(self._surface_uids)
+        visible_surfaces = self._surface_index.surfaces_with_markers(
+            corners_by_uid.keys()
+        )
+        for surface in visible_surfaces:
+            surface_locations[surface.uid] = self._tracker.locate_surface(
                 surface=surface,
                 markers=markers,
             )
-            for surface in self._surfaces
-        }
-
-        gaze_undistorted = self._camera.undistort_points_on_image_plane(
-            [[g.x, g.y] for g in gaze]
-        )
+        if frame_timestamp is not None:
+            self._location_history.add(frame_timestamp, surface_locations)
+        t_locate = time.perf_counter()
 
         gaze_mapped_norm: npt.NDArray[np.float32]
-        mapped_gaze: Dict[SurfaceId, List[MarkerMappedGaze]] = {}
+        mapped_gaze: Dict[SurfaceId, SurfaceGazeColumns] = {}
         for surface_uid, location in surface_locations.items():
-            if location is None:
-                mapped_gaze[surface_uid] = []
+            if location is None or not len(gaze_undistorted):
+                mapped_gaze[surface_uid] = _EMPTY_SURFACE_GAZE
                 continue
 
             gaze_mapped_norm = location._map_from_image_to_surface(gaze_undistorted)
-            mapped_gaze[location.surface_uid] = [
-                MarkerMappedGaze.from_norm_pos(surface_uid, norm, base)
-                for base, norm in zip(gaze, gaze_mapped_norm.tolist())
-            ]
+            mapped_gaze[surface_uid] = SurfaceGazeColumns.from_norm_pos(
+                gaze.timestamps, gaze_mapped_norm
+            )
+        if self._gaze_filter is not None:
+            mapped_gaze = self._gaze_filter.apply(mapped_gaze)
+        t_map_gaze = time.perf_counter()
+
+        if self.metrics is not None:
+            metrics = self.metrics
+            metrics.observe_stage("gray", t_gray - t_start)
+            metrics.observe_stage("detect", t_detect - t_gray)
+            metrics.observe_stage("undistort", t_undistort - t_detect)
+            metrics.observe_stage("locate", t_locate - t_undistort)
+            metrics.observe_stage("map_gaze", t_map_gaze - t_locate)
+            metrics.observe_stage("total", t_map_gaze - t_start)
+            metrics.observe_frame(len(markers))
+            for surface_uid, location in surface_locations.items():
+                metrics.observe_surface(surface_uid, location is not None)
+
+        stage_timestamps = _gaze_stage_timestamps(gaze)
+        stage_timestamps["detected"] = wall_start + (t_detect - t_start)
+        stage_timestamps["mapped"] = wall_start + (t_map_gaze - t_start)
+        return ColumnarMarkerMapperResult(
+            markers, surface_locations, mapped_gaze, gaze, base_data, stage_timestamps
+        )
 
-        return MarkerMapperResult(markers, surface_locations, mapped_gaze)
+    def map_gaze(
+        self, gaze: "GazeColumns", base_data: Optional[Sequence[GazeData]] = None
+    ) -> Optional["ColumnarMarkerMapperResult"]:
+        """Map gaze independently of the scene frames.
+
+        Every sample is mapped with the surface location interpolated, or
+        extrapolated, to its timestamp from the two nearest frames processed with a
+        `frame_timestamp`. The result contains no markers or surface locations.
+        """
+        if self._camera is None:
+            return None
+        with self._image_size_lock:
+            gaze_undistorted = self._camera.undistort_points_on_image_plane(
+                np.column_stack((gaze.x, gaze.y))
+            )
+            mapped_gaze = self._location_history.map_gaze(
+                gaze.timestamps, gaze_undistorted
+            )
+        if self._gaze_filter is not None:
+            mapped_gaze = self._gaze_filter.apply(mapped_gaze)
+        stage_timestamps = _gaze_stage_timestamps(gaze)
+        stage_timestamps["mapped"] = time.time()
+        return ColumnarMarkerMapperResult(
+            [], {}, mapped_gaze, gaze, base_data, stage_timestamps
+        )
 
     def add_core_surface_definitions_from_file(self, path: str) -> None:
-        path = os.path.expanduser(path)
-        with open(path, "rb") as fh:
-            surface_definitions = msgpack.unpack(fh)
-            surfaces = [
-                _CoreSurface.from_dict(surf) for surf in surface_definitions["surfaces"]
-            ]
-            self._surfaces.extend(surfaces)
+        self.add_surfaces(load_core_surface_definitions(path))
+
+    def add_surfaces(self, surfaces: Iterable[Surface]) -> None:
+        surfaces = list(surfaces)
+        self._surfaces.extend(surfaces)
+        self._surface_uids = tuple(surface.uid for surface in self._surfaces)
+        for surface in surfaces:
+            self._surface_index.add(surface)
+        if self._detector is not None:
+            self._detector.set_marker_uids(self._surface_index.marker_uids)
+
+    def warm_up(self, frame_shape: Tuple[int, int] = (1080, 1088)) -> None:
+        """Prepare the camera lookup tables and run the detector once so the first
+        frame is not delayed
+        """
+        if self._camera is not None:
+            self._set_image_size((frame_shape[1], frame_shape[0]))
+        if self._detector is not None:
+            self._detector.warm_up(frame_shape)
 
     @property
     def camera(self) -> Optional["RadialDistorsionCamera"]:
         return self._camera
 
+    def _set_image_size(self, image_size: Tuple[int, int]) -> None:
+        # Surface locations of frames with another resolution are not comparable
+        with self._image_size_lock:
+            self._camera.set_image_size(image_size)
+            self._location_history = SurfaceLocationHistory()
+
     @camera.setter
     def camera(self, camera: Optional["RadialDistorsionCamera"]) -> None:
         self._camera = camera
         if camera is None:
             self._detector = None
         else:
-            self._detector = ApriltagDetector(camera)
+            self._detector = ApriltagDetector(camera, **self._detector_options)
+            self._detector.set_marker_uids(self._surface_index.marker_uids)
 
     @property
     def surfaces(self) -> Tuple[Surface]:
         return tuple(self._surfaces)
 
 
+class _FrameBuffers:
+    """Arrays reused between frames, sized from the first frame and grown as needed"""
+
+    def __init__(self, point_capacity: int = 64) -> None:
+        self._gray = np.empty((0, 0), dtype=np.uint8)
+        self._points = np.empty((point_capacity, 2), dtype=np.float64)
+        self._undistorted = np.empty((point_capacity, 2), dtype=np.float64)
+
+    def gray(self, frame_shape: Tuple[int, ...]) -> npt.NDArray[np.uint8]:
+        if self._gray.shape != frame_shape[:2]:
+            self._gray = np.empty(frame_shape[:2], dtype=np.uint8)
+        return self._gray
+
+    def points(
+        self, count: int
+    ) -> Tuple[npt.NDArray[np.float64], npt.NDArray[np.float64]]:
+        """Input and output point buffers (Nx2) for undistorting `count` points"""
+        if count > len(self._points):
+            capacity = max(count, 2 * len(self._points))
+            self._points = np.empty((capacity, 2), dtype=np.float64)
+            self._undistorted = np.empty((capacity, 2), dtype=np.float64)
+        return self._points[:count], self._undistorted[:count]
+
+
+class SurfaceMarkerIndex:
+    """Inverted index from marker uid to the surfaces the marker is registered to"""
+
+    def __init__(self, surfaces: Iterable[Surface] = (), min_marker_count: int = 1):
+        """
+        :param min_marker_count: Number of registered markers of a surface that need
+            to be visible for it to be evaluated
+        """
+        self._min_marker_count = min_marker_count
+        self._surfaces: List[Surface] = []
+        self._surface_indices_by_marker_uid: Dict[MarkerId, List[int]] = {}
+        for surface in surfaces:
+            self.add(surface)
+
+    @property
+    def marker_uids(self) -> Set[MarkerId]:
+        return set(self._surface_indices_by_marker_uid)
+
+    def add(self, surface: Surface) -> None:
+        surface_index = len(self._surfaces)
+        self._surfaces.append(surface)
+        for marker_uid in surface._registered_markers_by_uid_undistorted:
+            self._surface_indices_by_marker_uid.setdefault(marker_uid, []).append(
+                surface_index
+            )
+
+    def surfaces_with_markers(self, marker_uids: Iterable[MarkerId]) -> List[Surface]:
+        """Surfaces with at least `min_marker_count` of `marker_uids` registered"""
+        counts: Dict[int, int] = {}
+        for marker_uid in marker_uids:
+            surface_indices = self._surface_indices_by_marker_uid.get(marker_uid, ())
+            for surface_index in surface_indices:
+                counts[surface_index] = counts.get(surface_index, 0) + 1
+        return [
+            self._surfaces[surface_index]
+            for surface_index, count in sorted(counts.items())
+            if count >= self._min_marker_count
+        ]
+
+
+def load_core_surface_definitions(
+    path: str, cache: bool = True, cache_dir: Optional[str] = None
+) -> List[Surface]:
+    """Load Pupil Capture surface definitions.
+
+    Parsed surfaces are cached as `surface_definitions.<hash>.pickle` in `cache_dir`,
+    by default next to the definitions file, which loads directly into ready-to-use
+    surfaces on the next start. The hash covers the definitions, the surface tracker
+    version and the surface format version.
+    """
+    path = os.path.expanduser(path)
+    with open(path, "rb") as fh:
+        source = fh.read()
+
+    cache_file = None
+    if cache:
+        key = hashlib.sha256(source)
+        key.update(f"{_surface_tracker_version()}:{_CoreSurface.version}".encode())
+        cache_name = f"surface_definitions.{key.hexdigest()[:16]}.pickle"
+        cache_file = os.path.join(cache_dir or os.path.dirname(path), cache_name)
+        try:
+            with open(cache_file, "rb") as fh:
+                return pickle.load(fh)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            pass
+
+    surface_definitions = msgpack.unpackb(source)
+    surfaces = [
+        _CoreSurface.from_dict(surf) for surf in surface_definitions["surfaces"]
+    ]
+
+    if cache_file is not None:
+        try:
+            with open(cache_file, "wb") as fh:
+                pickle.dump(surfaces, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        except OSError:
+            logging.warning(f"Unable to cache surface definitions to {cache_file}")
+    return surfaces
+
+
+def _surface_tracker_version() -> str:
+    try:
+        from importlib.metadata import version
+
+        return version("surface-tracker")
+    except ImportError:  # Python < 3.8, or not installed as a distribution
+        return "unknown"
+
+
 class MarkerMappedGaze(NamedTuple):
     aoi_id: SurfaceId
     x: float
@@ -131,106 +424,386 @@ class MarkerMapperResult(NamedTuple):
     markers: List[Marker]
     located_aois: Dict[SurfaceId, Optional[SurfaceLocation]]
     mapped_gaze: Dict[SurfaceId, List[MarkerMappedGaze]]
+    # Unix timestamps of the pipeline stages, by stage name. "gaze" is the timestamp
+    # of the newest gaze sample, "detected" and "mapped" are set by the mapper.
+    stage_timestamps: Optional[Dict[str, float]] = None
 
 
-# Source: pupil/pupil_src/shared_modules/camera_model.py
-# TODO: Use https://github.com/pupil-labs/camera instead
-class RadialDistorsionCamera:
-    """Camera model assuming a lense with radial distortion (this is the defaut model in opencv).
-    Provides functionality to make use of a pinhole camera calibration that is also compensating for lense distortion
-    """
+class GazeColumns(NamedTuple):
+    """Gaze samples in scene camera pixels, one array entry per sample"""
 
-    def __init__(self, K: npt.ArrayLike, D: npt.ArrayLike):
-        self.K = np.array(K)
-        self.D = np.array(D)
+    timestamps: npt.NDArray[np.float64]
+    x: npt.NDArray[np.float64]
+    y: npt.NDArray[np.float64]
+    worn: npt.NDArray[np.bool_]
 
-    # CameraModel Interface
+    @staticmethod
+    def empty() -> "GazeColumns":
+        return _EMPTY_GAZE
 
-    def undistort_points_on_image_plane(self, points):
-        points = self.__unprojectPoints(points, use_distortion=True)
-        points = self.__projectPoints(points, use_distortion=False)
-        return points
+    @staticmethod
+    def from_gaze_data(gaze: Sequence[GazeData]) -> "GazeColumns":
+        values = np.array(
+            [(g.timestamp_unix_seconds, g.x, g.y, g.worn) for g in gaze],
+            dtype=np.float64,
+        ).reshape((-1, 4))
+        return GazeColumns(
+            values[:, 0], values[:, 1], values[:, 2], values[:, 3].astype(bool)
+        )
 
-    def distort_points_on_image_plane(self, points):
-        points = self.__unprojectPoints(points, use_distortion=False)
-        points = self.__projectPoints(points, use_distortion=True)
-        return points
+    def to_gaze_data(self) -> List[GazeData]:
+        return [
+            GazeData(x=x, y=y, worn=worn, timestamp_unix_seconds=ts)
+            for ts, x, y, worn in zip(
+                self.timestamps.tolist(),
+                self.x.tolist(),
+                self.y.tolist(),
+                self.worn.tolist(),
+            )
+        ]
 
-    def distort_and_project(self, *args, **kwargs):
-        return self.distort_points_on_image_plane(*args, **kwargs)
+    def slice(self, start: int, stop: int) -> "GazeColumns":
+        return GazeColumns(*(column[start:stop] for column in self))
 
-    def undistort_image(self, img):
-        return cv2.undistort(img, self.K, self.D)
 
-    # Private
+class SurfaceGazeColumns(NamedTuple):
+    """Gaze mapped to a surface in normalized surface coordinates"""
 
-    def __projectPoints(self, object_points, rvec=None, tvec=None, use_distortion=True):
-        """
-        Projects a set of points onto the camera plane as defined by the camera model.
-        :param object_points: Set of 3D world points
-        :param rvec: Set of vectors describing the rotation of the camera when recording the corresponding object point
-        :param tvec: Set of vectors describing the translation of the camera when recording the corresponding object point
-        :return: Projected 2D points
-        """
-        input_dim = object_points.ndim
+    timestamps: npt.NDArray[np.float64]
+    x: npt.NDArray[np.float64]
+    y: npt.NDArray[np.float64]
+    is_on_aoi: npt.NDArray[np.bool_]
 
-        object_points = object_points.reshape((1, -1, 3))
+    @staticmethod
+    def from_norm_pos(
+        timestamps: npt.NDArray[np.float64], norm_pos: npt.ArrayLike
+    ) -> "SurfaceGazeColumns":
+        norm_pos = np.asarray(norm_pos, dtype=np.float64).reshape((-1, 2))
+        on_surface = np.all((norm_pos >= 0.0) & (norm_pos <= 1.0), axis=1)
+        x, y = norm_pos[:, 0], norm_pos[:, 1]
+        return SurfaceGazeColumns(timestamps, x, y, on_surface)
+
+    def to_mapped_gaze(
+        self, aoi_id: SurfaceId, base_data: Sequence[GazeData]
+    ) -> List[MarkerMappedGaze]:
+        return [
+            MarkerMappedGaze(aoi_id, x, y, on_surface, base)
+            for x, y, on_surface, base in zip(
+                self.x.tolist(), self.y.tolist(), self.is_on_aoi.tolist(), base_data
+            )
+        ]
 
-        if rvec is None:
-            rvec = np.zeros(3).reshape(1, 1, 3)
-        else:
-            rvec = np.array(rvec).reshape(1, 1, 3)
 
-        if tvec is None:
-            tvec = np.zeros(3).reshape(1, 1, 3)
-        else:
-            tvec = np.array(tvec).reshape(1, 1, 3)
+_EMPTY_GAZE = GazeColumns(np.empty(0), np.empty(0), np.empty(0), np.empty(0, bool))
+_EMPTY_SURFACE_GAZE = SurfaceGazeColumns(
+    np.empty(0), np.empty(0), np.empty(0), np.empty(0, dtype=bool)
+)
 
-        if use_distortion:
-            _D = self.D
-        else:
-            _D = np.asarray([[0.0, 0.0, 0.0, 0.0, 0.0]])
 
-        image_points, jacobian = cv2.projectPoints(
-            object_points, rvec, tvec, self.K, _D
+class ColumnarMarkerMapperResult:
+    """Mapper result holding the mapped gaze of every surface as columns.
+
+    Provides the attributes of `MarkerMapperResult`; its `mapped_gaze` lists of
+    `MarkerMappedGaze` are only built when first accessed.
+    """
+
+    def __init__(
+        self,
+        markers: List[Marker],
+        located_aois: Dict[SurfaceId, Optional[SurfaceLocation]],
+        gaze: Dict[SurfaceId, SurfaceGazeColumns],
+        gaze_columns: GazeColumns,
+        base_data: Optional[Sequence[GazeData]] = None,
+        stage_timestamps: Optional[Dict[str, float]] = None,
+    ) -> None:
+        self.markers = markers
+        self.located_aois = located_aois
+        self.gaze = gaze
+        self._gaze_columns = gaze_columns
+        self._base_data = base_data
+        self.stage_timestamps = {} if stage_timestamps is None else stage_timestamps
+        self._mapped_gaze: Optional[Dict[SurfaceId, List[MarkerMappedGaze]]] = None
+
+    @property
+    def mapped_gaze(self) -> Dict[SurfaceId, List[MarkerMappedGaze]]:
+        if self._mapped_gaze is None:
+            if self._base_data is None:
+                self._base_data = self._gaze_columns.to_gaze_data()
+            self._mapped_gaze = {
+                surface_uid: columns.to_mapped_gaze(surface_uid, self._base_data)
+                for surface_uid, columns in self.gaze.items()
+            }
+        return self._mapped_gaze
+
+    def to_result(self) -> MarkerMapperResult:
+        return MarkerMapperResult(
+            self.markers, self.located_aois, self.mapped_gaze, self.stage_timestamps
         )
 
-        if input_dim == 2:
-            image_points.shape = (-1, 2)
-        elif input_dim == 3:
-            image_points.shape = (-1, 1, 2)
-        return image_points
 
-    def __unprojectPoints(self, pts_2d, use_distortion=True, normalize=False):
+def _multiply_columns(
+    values: npt.NDArray[np.float64], factors: npt.NDArray[np.float64]
+) -> None:
+    # In place and without the ufunc buffer of broadcasting `factors[:, None]`
+    for column in range(values.shape[1]):
+        np.multiply(values[:, column], factors, out=values[:, column])
+
+
+def _gaze_stage_timestamps(gaze: GazeColumns) -> Dict[str, float]:
+    if not len(gaze.timestamps):
+        return {}
+    return {"gaze": float(np.max(gaze.timestamps))}
+
+
+# Source: pupil/pupil_src/shared_modules/camera_model.py
+# TODO: Use https://github.com/pupil-labs/camera instead
+class RadialDistorsionCamera:
+    """Camera model assuming a lense with radial distortion (this is the defaut model in opencv).
+    Provides functionality to make use of a pinhole camera calibration that is also compensating for lense distortion
+    """
+
+    def __init__(
+        self,
+        K: npt.ArrayLike,
+        D: npt.ArrayLike,
+        cache_prefix: Optional[str] = None,
+        point_grid_step: int = 4,
+    ):
         """
-        Undistorts points according to the camera model.
-        :param pts_2d, shape: Nx2
-        :return: Array of unprojected 3d points, shape: Nx3
+        :param cache_prefix: If set, undistortion lookup tables are saved to
+            `<cache_prefix>.<width>x<height>.<intrinsics hash>.<table>.npy` files
+            and memory-mapped on subsequent runs
+        :param point_grid_step: Spacing in pixels of the grid used to interpolate
+            undistorted points, see `set_image_size`
         """
-        pts_2d = np.array(pts_2d, dtype=np.float32)
+        self.K = np.array(K, dtype=np.float64)
+        self.D = np.array(D, dtype=np.float64)
+        self.cache_prefix = cache_prefix
+        self._K_2x2_T = self.K[:2, :2].T.copy()
+        self._K_2x2_inv_T = np.linalg.inv(self.K[:2, :2]).T
+        self._principal_point = self.K[:2, 2].copy()
+        self._zero_vec = np.zeros(3).reshape(1, 1, 3)
+        self._intrinsics_hash = hashlib.sha256(
+            self.K.tobytes() + self.D.tobytes()
+        ).hexdigest()[:8]
+        self._point_grid_step = point_grid_step
+        self._point_grid: Optional[npt.NDArray[np.float64]] = None
+        # Grid nodes as a flat Nx2 view, and the exclusive upper bound of grid cells
+        self._point_grid_nodes: Optional[npt.NDArray[np.float64]] = None
+        self._point_grid_cells = (0, 0)
+        # Guards swapping the grid while another thread looks up points
+        self._point_grid_lock = threading.Lock()
+        # Per-thread scratch arrays of the grid lookup; gaze and frames may be
+        # undistorted concurrently
+        self._scratch = threading.local()
+        self._image_size: Optional[Tuple[int, int]] = None
+        self._remap_tables: Dict[Tuple[int, int], npt.NDArray[np.float32]] = {}
 
-        # Delete any posibly wrong 3rd dimension
-        if pts_2d.ndim == 1 or pts_2d.ndim == 3:
-            pts_2d = pts_2d.reshape((-1, 2))
+    @property
+    def image_size(self) -> Optional[Tuple[int, int]]:
+        return self._image_size
 
-        # Add third dimension the way cv2 wants it
-        if pts_2d.ndim == 2:
-            pts_2d = pts_2d.reshape((-1, 1, 2))
+    def set_image_size(self, image_size: Tuple[int, int]) -> None:
+        """Prepare the point lookup grid for images of (width, height) pixels.
 
-        if use_distortion:
-            _D = self.D
-        else:
-            _D = np.asarray([[0.0, 0.0, 0.0, 0.0, 0.0]])
+        Afterwards, points inside the image are undistorted by bilinear interpolation
+        between precomputed grid nodes instead of solving the distortion model.
+        """
+        image_size = (int(image_size[0]), int(image_size[1]))
+        if image_size == self._image_size:
+            return
+        step = self._point_grid_step
+        point_grid = self.__load_or_build_table(
+            f"points{step}",
+            image_size,
+            (image_size[1] // step + 2, image_size[0] // step + 2, 2),
+            self.__build_point_grid,
+        )
+        rows, cols = point_grid.shape[:2]
+        with self._point_grid_lock:
+            self._point_grid = point_grid
+            self._point_grid_nodes = point_grid.reshape((-1, 2))
+            self._point_grid_cells = (cols - 1, rows - 1)
+            self._image_size = image_size
 
-        pts_2d_undist = cv2.undistortPoints(pts_2d, self.K, _D)
+    # CameraModel Interface
 
-        pts_3d = cv2.convertPointsToHomogeneous(pts_2d_undist)
-        pts_3d.shape = -1, 3
+    def undistort_points_on_image_plane(self, points, out=None):
+        """Undistort all points in a single batch; returns an Nx2 array
 
-        if normalize:
-            pts_3d /= np.linalg.norm(pts_3d, axis=1)[:, np.newaxis]
+        :param out: Optional Nx2 float64 array the result is written to
+        """
+        points = self.__as_points(points)
+        if not len(points):
+            return points
+        with self._point_grid_lock:
+            nodes, cells = self._point_grid_nodes, self._point_grid_cells
+        if nodes is None:
+            return self.__undistort_points(points, out)
+        return self.__undistort_points_from_grid(points, nodes, cells, out)
 
-        return pts_3d
+    def distort_points_on_image_plane(self, points):
+        """Distort all points in a single batch; returns an Nx2 array"""
+        points = self.__as_points(points)
+        if not len(points):
+            return points
+        # Unprojecting undistorted points is a multiplication by the inverse of K
+        object_points = np.ones((1, len(points), 3))
+        object_points[0, :, :2] = (points - self._principal_point) @ self._K_2x2_inv_T
+        image_points, _ = cv2.projectPoints(
+            object_points, self._zero_vec, self._zero_vec, self.K, self.D
+        )
+        return image_points.reshape((-1, 2))
+
+    def distort_and_project(self, *args, **kwargs):
+        return self.distort_points_on_image_plane(*args, **kwargs)
+
+    def undistort_image(self, img):
+        image_size = (img.shape[1], img.shape[0])
+        remap_table = self._remap_tables.get(image_size)
+        if remap_table is None:
+            remap_table = self._remap_tables[image_size] = self.__load_or_build_table(
+                "remap", image_size, img.shape[:2] + (2,), self.__build_remap_table
+            )
+        return cv2.remap(img, remap_table, None, cv2.INTER_LINEAR)
+
+    # Private
+
+    def __undistort_points(self, points, out=None) -> npt.NDArray[np.float64]:
+        normalized = cv2.undistortPoints(points.reshape((-1, 1, 2)), self.K, self.D)
+        # Projecting normalized points without distortion is a multiplication by K
+        out = np.matmul(normalized.reshape((-1, 2)), self._K_2x2_T, out=out)
+        out += self._principal_point
+        return out
+
+    def __undistort_points_from_grid(
+        self, points, nodes, cells, out=None
+    ) -> npt.NDArray[np.float64]:
+        # All intermediate results are written to reused scratch arrays
+        count = len(points)
+        cols = cells[0] + 1
+        scaled = self.__scratch("scaled", count, 2, np.float64)
+        cell = self.__scratch("cell", count, 2, np.float64)
+        bounds = self.__scratch("bounds", count, 2, np.bool_)
+        inside = self.__scratch("inside", count, 0, np.bool_)
+        inside_upper = self.__scratch("inside_upper", count, 0, np.bool_)
+        np.divide(points, self._point_grid_step, out=scaled)
+        np.floor(scaled, out=cell)
+        np.greater_equal(cell, 0.0, out=bounds)
+        np.all(bounds, axis=1, out=inside)
+        # Column by column; broadcasting would make NumPy allocate ufunc buffers
+        for column, limit in enumerate(cells):
+            np.less(cell[:, column], limit, out=bounds[:, column])
+        np.all(bounds, axis=1, out=inside_upper)
+        inside &= inside_upper
+        if not inside.all():
+            # Gaze may fall outside of the image; solve those points exactly. The
+            # mask is copied since the recursion reuses the scratch arrays.
+            inside = inside.copy()
+            undistorted = np.empty_like(points) if out is None else out
+            undistorted[~inside] = self.__undistort_points(points[~inside])
+            undistorted[inside] = self.__undistort_points_from_grid(
+                points[inside], nodes, cells
+            )
+            return undistorted
+
+        # Flat index of the top-left node of each cell; cell values are integral.
+        # Indices are in range, "clip" only avoids the buffering of `out`.
+        node_index = self.__scratch("node_index", count, 0, np.float64)
+        index = self.__scratch("index", count, 0, np.intp)
+        np.multiply(cell[:, 1], cols, out=node_index)
+        node_index += cell[:, 0]
+        np.copyto(index, node_index, casting="unsafe")
+        # Interpolation weights within the cell
+        weights = np.subtract(scaled, cell, out=scaled)
+        wx, wy = weights[:, 0], weights[:, 1]
+
+        top = self.__scratch("top", count, 2, np.float64)
+        bottom = self.__scratch("bottom", count, 2, np.float64)
+        delta = self.__scratch("delta", count, 2, np.float64)
+        np.take(nodes, index, axis=0, mode="clip", out=top)
+        index += 1
+        np.take(nodes, index, axis=0, mode="clip", out=delta)
+        delta -= top
+        _multiply_columns(delta, wx)
+        top += delta
+        index += cols
+        np.take(nodes, index, axis=0, mode="clip", out=delta)
+        index -= 1
+        np.take(nodes, index, axis=0, mode="clip", out=bottom)
+        delta -= bottom
+        _multiply_columns(delta, wx)
+        bottom += delta
+
+        out = np.subtract(bottom, top, out=out)
+        _multiply_columns(out, wy)
+        out += top
+        return out
+
+    def __scratch(
+        self, name: str, count: int, width: int, dtype: type
+    ) -> np.ndarray:
+        """Reused array of `count` rows of `width` values (1-D if 0), grown as needed"""
+        buffer = getattr(self._scratch, name, None)
+        if buffer is None or len(buffer) < count:
+            rows = max(count, 2 * (0 if buffer is None else len(buffer)), 64)
+            buffer = np.empty((rows, width) if width else (rows,), dtype=dtype)
+            setattr(self._scratch, name, buffer)
+        return buffer[:count]
+
+    def __build_point_grid(
+        self, image_size: Tuple[int, int]
+    ) -> npt.NDArray[np.float64]:
+        step = self._point_grid_step
+        cols = image_size[0] // step + 2
+        rows = image_size[1] // step + 2
+        xs, ys = np.meshgrid(np.arange(cols) * step, np.arange(rows) * step)
+        nodes = np.stack((xs, ys), axis=-1).reshape((-1, 2)).astype(np.float64)
+        return self.__undistort_points(nodes).reshape((rows, cols, 2))
+
+    def __build_remap_table(
+        self, image_size: Tuple[int, int]
+    ) -> npt.NDArray[np.float32]:
+        remap_table, _ = cv2.initUndistortRectifyMap(
+            self.K, self.D, None, self.K, image_size, cv2.CV_32FC2
+        )
+        return remap_table
+
+    def __load_or_build_table(
+        self,
+        name: str,
+        image_size: Tuple[int, int],
+        shape: Tuple[int, ...],
+        build: Callable[[Tuple[int, int]], np.ndarray],
+    ) -> np.ndarray:
+        if self.cache_prefix is None:
+            return build(image_size)
+        width, height = image_size
+        cache_file = (
+            f"{self.cache_prefix}.{width}x{height}.{self._intrinsics_hash}.{name}.npy"
+        )
+        try:
+            table = np.load(cache_file, mmap_mode="r")
+            # Guard against tables written with different grid parameters
+            if table.shape == shape:
+                return table
+        except (OSError, ValueError):
+            pass
+        table = build(image_size)
+        try:
+            # Write atomically, other processes may be loading the same table
+            temp_file = f"{cache_file}.{os.getpid()}.tmp"
+            with open(temp_file, "wb") as fh:
+                np.save(fh, table)
+            os.replace(temp_file, cache_file)
+        except OSError:
+            logging.warning(f"Unable to cache undistortion table to {cache_file}")
+        return table
+
+    @staticmethod
+    def __as_points(points) -> npt.NDArray[np.float64]:
+        # Accepts Nx2, Nx1x2 or flat point arrays
+        return np.asarray(points, dtype=np.float64).reshape((-1, 2))
 
 
 def create_apriltag_marker_uid(tag_family: str, tag_id: int) -> MarkerId:
@@ -239,31 +812,234 @@ def create_apriltag_marker_uid(tag_family: str, tag_id: int) -> MarkerId:
 
 
 class ApriltagDetector:
-    def __init__(self, camera_model: RadialDistorsionCamera):
-        families = "tag36h11"
+    def __init__(
+        self,
+        camera_model: RadialDistorsionCamera,
+        roi_tracking: bool = False,
+        roi_padding: float = 0.5,
+        full_scan_interval: int = 30,
+        latency_budget: Optional[float] = None,
+        coarse_to_fine_levels: int = 0,
+        nthreads: Optional[int] = None,
+    ):
+        """
+        :param roi_tracking: Only search the regions around the markers found in the
+            previous frame. A full frame scan is performed whenever a previously
+            found marker goes missing and every `full_scan_interval` frames.
+        :param roi_padding: Padding added around each tracked marker, relative to the
+            size of its bounding box.
+        :param latency_budget: Target detection time per frame in seconds. If set, the
+            detector settings are adjusted at runtime by a `DetectorAutoTuner`.
+        :param coarse_to_fine_levels: If greater than zero, markers are detected on an
+            image pyramid level downscaled by `2 ** coarse_to_fine_levels` and their
+            corners are refined to sub-pixel accuracy on the full resolution image.
+        :param nthreads: Detector threads, 2 by default. With a `latency_budget`, the
+            most threads the auto-tuner may use.
+        """
+        self._families = "tag36h11"
+        self._nthreads = 2 if nthreads is None else nthreads
         self._camera_model = camera_model
-        self._detector = pupil_apriltags.Detector(
-            families=families, nthreads=2, quad_decimate=2.0, decode_sharpening=1.0
-        )
+        self._detectors: Dict[Tuple[int, float], pupil_apriltags.Detector] = {}
+        self._auto_tuner: Optional[DetectorAutoTuner] = None
+        if latency_budget is not None and nthreads is not None:
+            self._auto_tuner = DetectorAutoTuner(latency_budget, max_threads=nthreads)
+        elif latency_budget is not None:
+            self._auto_tuner = DetectorAutoTuner(latency_budget)
+        self._coarse_to_fine_levels = coarse_to_fine_levels
+        self._roi_tracking = roi_tracking
+        self._roi_padding = roi_padding
+        self._full_scan_interval = full_scan_interval
+        self._previous_corners: Dict[MarkerId, npt.NDArray[np.float64]] = {}
+        self._frames_since_full_scan = 0
+        self._tag_ids: Optional[Set[int]] = None
+        self._gray = np.empty((0, 0), dtype=np.uint8)
+
+    def set_marker_uids(self, marker_uids: Optional[Iterable[MarkerId]]) -> None:
+        """Only report markers with these uids; report all markers if empty or None"""
+        marker_uids = set(marker_uids or ())
+        prefix = f"{self._families}:"
+        tag_ids = {
+            int(uid[len(prefix) :]) for uid in marker_uids if uid.startswith(prefix)
+        }
+        self._tag_ids = tag_ids or None
+        if self._tag_ids is not None:
+            self._previous_corners = {
+                uid: corners
+                for uid, corners in self._previous_corners.items()
+                if uid in marker_uids
+            }
 
     def detect_from_image(self, image: npt.NDArray[np.uint8]) -> List[Marker]:
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        if self._gray.shape != image.shape[:2]:
+            self._gray = np.empty(image.shape[:2], dtype=np.uint8)
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=self._gray)
         return self.detect_from_gray(gray)
 
     def detect_from_gray(self, gray: npt.NDArray[np.uint8]) -> List[Marker]:
+        corners_by_uid = self.detect_corners_from_gray(gray)
+        return self.markers_from_corners(corners_by_uid)
+
+    def detect_corners_from_gray(
+        self, gray: npt.NDArray[np.uint8]
+    ) -> Dict[MarkerId, npt.NDArray[np.float64]]:
+        """Detect markers and return their distorted image corners (4x2) by uid"""
+        t_start = time.perf_counter()
+        if self._should_scan_full_frame():
+            corners_by_uid = self._detect_in_region(gray)
+            self._frames_since_full_scan = 0
+        else:
+            regions = self._tracking_regions(gray.shape)
+            corners_by_uid = {}
+            for region in regions:
+                corners_by_uid.update(self._detect_in_region(gray, region))
+            self._frames_since_full_scan += 1
+
+            # Fall back to a full scan if any of the tracked markers went missing
+            if not self._previous_corners.keys() <= corners_by_uid.keys():
+                corners_by_uid = self._detect_in_region(gray)
+                self._frames_since_full_scan = 0
+
+        if self._roi_tracking:
+            self._previous_corners = corners_by_uid
+        if self._auto_tuner is not None:
+            self._auto_tuner.update(time.perf_counter() - t_start, corners_by_uid)
+        return corners_by_uid
+
+    def warm_up(self, image_shape: Tuple[int, int]) -> None:
+        blank = np.zeros(image_shape[:2], dtype=np.uint8)
+        self._get_detector().detect(blank)
+        if self._coarse_to_fine_levels > 0:
+            self._get_detector(quad_decimate=1.0).detect(blank)
+
+    def update_tracked_corners(
+        self, corners_by_uid: Mapping[MarkerId, npt.NDArray[np.float64]]
+    ) -> None:
+        """Seed the next region-of-interest search with externally tracked corners"""
+        if self._roi_tracking:
+            self._previous_corners = dict(corners_by_uid)
+
+    def markers_from_corners(
+        self, corners_by_uid: Mapping[MarkerId, npt.NDArray[np.float64]]
+    ) -> List[Marker]:
+        # Undistort the corners of all markers in one batch
+        corners = np.reshape(list(corners_by_uid.values()), (-1, 2))
+        vertices = self._camera_model.undistort_points_on_image_plane(corners)
+        return self.markers_from_undistorted_corners(corners_by_uid.keys(), vertices)
+
+    def markers_from_undistorted_corners(
+        self, uids: Iterable[MarkerId], vertices: npt.NDArray[np.float64]
+    ) -> List[Marker]:
+        """Convert undistorted corners (Nx2, 4 per marker) into surface markers"""
+        # Convert apriltag markers into surface tracker markers
+        marker_fn = self.__vertices_to_surface_marker
+        vertices = vertices.reshape((-1, 4, 2))
+        return [marker_fn(uid, verts) for uid, verts in zip(uids, vertices)]
+
+    def _get_detector(
+        self, quad_decimate: Optional[float] = None
+    ) -> pupil_apriltags.Detector:
+        if self._auto_tuner is None:
+            nthreads, default_quad_decimate = self._nthreads, 2.0
+        else:
+            nthreads, default_quad_decimate = self._auto_tuner.settings
+        if quad_decimate is None:
+            quad_decimate = default_quad_decimate
+        key = (nthreads, quad_decimate)
+        if key not in self._detectors:
+            self._detectors[key] = pupil_apriltags.Detector(
+                families=self._families,
+                nthreads=nthreads,
+                quad_decimate=quad_decimate,
+                decode_sharpening=1.0,
+            )
+        return self._detectors[key]
+
+    def _should_scan_full_frame(self) -> bool:
+        return (
+            not self._roi_tracking
+            or not self._previous_corners
+            or self._frames_since_full_scan >= self._full_scan_interval
+        )
+
+    def _detect_in_region(
+        self,
+        gray: npt.NDArray[np.uint8],
+        region: Optional[Tuple[int, int, int, int]] = None,
+    ) -> Dict[MarkerId, npt.NDArray[np.float64]]:
+        if region is None:
+            x0, y0 = 0, 0
+        else:
+            x0, y0, x1, y1 = region
+            gray = gray[y0:y1, x0:x1]
+
+        if self._coarse_to_fine_levels > 0:
+            return self._detect_coarse_to_fine(gray, offset=(x0, y0))
+
         # Detect apriltag markers from the gray image
-        markers = self._detector.detect(gray)
+        markers = self._known_markers(self._get_detector().detect(gray))
 
         # Ensure detected markers are unique
         # TODO: Between deplicate markers, pick the one with higher confidence
         uid_fn = self.__apiltag_marker_uid
-        markers = {uid_fn(m): m for m in markers}.values()
-
-        # Convert apriltag markers into surface tracker markers
-        marker_fn = self.__apriltag_marker_to_surface_marker
-        markers = [marker_fn(m) for m in markers]
+        offset = np.array([x0, y0], dtype=np.float64)
+        return {uid_fn(m): m.corners + offset for m in markers}
+
+    def _detect_coarse_to_fine(
+        self, gray: npt.NDArray[np.uint8], offset: Tuple[int, int]
+    ) -> Dict[MarkerId, npt.NDArray[np.float64]]:
+        levels = self._coarse_to_fine_levels
+        coarse = gray
+        for _ in range(levels):
+            coarse = cv2.pyrDown(coarse)
+
+        # The pyramid already decimated the image; find quads at full coarse resolution
+        markers = self._get_detector(quad_decimate=1.0).detect(coarse)
+        markers = self._known_markers(markers)
+        if not markers:
+            return {}
 
-        return markers
+        uid_fn = self.__apiltag_marker_uid
+        uids = [uid_fn(m) for m in markers]
+
+        # Map coarse pixel centers back to full resolution and refine the corners
+        scale = 2**levels
+        corners = np.array([m.corners for m in markers], dtype=np.float32)
+        corners = (corners + 0.5) * scale - 0.5
+        half_window = scale + 1
+        cv2.cornerSubPix(
+            gray,
+            corners.reshape((-1, 1, 2)),
+            (half_window, half_window),
+            (-1, -1),
+            (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, 0.01),
+        )
+        corners = corners.astype(np.float64) + offset
+        return dict(zip(uids, corners))
+
+    def _known_markers(
+        self, markers: List[pupil_apriltags.Detection]
+    ) -> List[pupil_apriltags.Detection]:
+        if self._tag_ids is None:
+            return markers
+        return [m for m in markers if m.tag_id in self._tag_ids]
+
+    def _tracking_regions(
+        self, image_shape: Tuple[int, ...]
+    ) -> List[Tuple[int, int, int, int]]:
+        height, width = image_shape[:2]
+        regions = []
+        for corners in self._previous_corners.values():
+            (x0, y0), (x1, y1) = corners.min(axis=0), corners.max(axis=0)
+            padding = max(x1 - x0, y1 - y0) * self._roi_padding + 8
+            regions.append(
+                (
+                    max(int(x0 - padding), 0),
+                    max(int(y0 - padding), 0),
+                    min(int(x1 + padding) + 1, width),
+                    min(int(y1 + padding) + 1, height),
+                )
+            )
+        return _merge_overlapping_regions(regions)
 
     @staticmethod
     def __apiltag_marker_uid(
@@ -273,17 +1049,11 @@ class ApriltagDetector:
         tag_id = int(apriltag_marker.tag_id)
         return create_apriltag_marker_uid(family, tag_id)
 
-    def __apriltag_marker_to_surface_marker(
-        self, apriltag_marker: pupil_apriltags.Detection
+    @staticmethod
+    def __vertices_to_surface_marker(
+        uid: MarkerId, vertices: npt.NDArray[np.float64]
     ) -> Marker:
 
-        # Construct the surface tracker marker UID
-        uid = ApriltagDetector.__apiltag_marker_uid(apriltag_marker)
-
-        # Extract vertices in the correct format form apriltag marker
-        vertices = [[point] for point in apriltag_marker.corners]
-        vertices = self._camera_model.undistort_points_on_image_plane(vertices)
-
         # TODO: Verify this is correct...
         starting_with = CornerId.TOP_LEFT
         clockwise = True
@@ -296,6 +1066,380 @@ class ApriltagDetector:
         )
 
 
+def _merge_overlapping_regions(
+    regions: List[Tuple[int, int, int, int]]
+) -> List[Tuple[int, int, int, int]]:
+    """Merge overlapping (x0, y0, x1, y1) regions until all regions are disjoint"""
+    merged = list(regions)
+    did_merge = True
+    while did_merge:
+        did_merge = False
+        for i in range(len(merged)):
+            for j in range(i + 1, len(merged)):
+                a, b = merged[i], merged[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    merged[i] = (
+                        min(a[0], b[0]),
+                        min(a[1], b[1]),
+                        max(a[2], b[2]),
+                        max(a[3], b[3]),
+                    )
+                    del merged[j]
+                    did_merge = True
+                    break
+            if did_merge:
+                break
+    return merged
+
+
+class DetectorAutoTuner:
+    """Picks the fastest detector settings that keep detection within a latency budget
+    while markers remain large enough to be found.
+
+    Settings are ordered from most accurate to fastest by `quad_decimate`; additional
+    threads are used before decimating further. A change is only made once the
+    smoothed detection time stayed outside of the budget band for `patience` frames,
+    and a finer setting is only chosen if its predicted time fits the budget.
+    """
+
+    QUAD_DECIMATE_LEVELS = (1.0, 1.5, 2.0, 3.0, 4.0)
+
+    def __init__(
+        self,
+        latency_budget: float,
+        max_threads: int = 4,
+        min_decimated_marker_size: float = 24.0,
+        low_watermark: float = 0.6,
+        patience: int = 15,
+        smoothing: float = 0.2,
+    ):
+        self._latency_budget = latency_budget
+        self._max_threads = max_threads
+        self._min_decimated_marker_size = min_decimated_marker_size
+        self._low_watermark = low_watermark
+        self._patience = patience
+        self._smoothing = smoothing
+
+        self._decimate_index = self.QUAD_DECIMATE_LEVELS.index(2.0)
+        self._nthreads = min(2, max_threads)
+        self._smoothed_duration: Optional[float] = None
+        self._frames_over_budget = 0
+        self._frames_under_budget = 0
+        self._frames_without_markers = 0
+
+    @property
+    def settings(self) -> Tuple[int, float]:
+        """Current `(nthreads, quad_decimate)`"""
+        return self._nthreads, self.QUAD_DECIMATE_LEVELS[self._decimate_index]
+
+    def update(
+        self,
+        duration: float,
+        corners_by_uid: Mapping[MarkerId, npt.NDArray[np.float64]],
+    ) -> None:
+        if self._smoothed_duration is None:
+            self._smoothed_duration = duration
+        else:
+            self._smoothed_duration += self._smoothing * (
+                duration - self._smoothed_duration
+            )
+
+        # Markers might be too small to be found; look closer if nothing is found
+        if not corners_by_uid:
+            self._frames_without_markers += 1
+            if self._frames_without_markers >= self._patience:
+                self._frames_without_markers = 0
+                if self._decimate_index > 0:
+                    self._decimate_index -= 1
+                    self._reset(duration)
+            return
+        self._frames_without_markers = 0
+
+        # Markers that became too small for the current decimation must not be lost
+        max_index = self._max_decimate_index(corners_by_uid)
+        if self._decimate_index > max_index:
+            self._decimate_index = max_index
+            self._reset(duration)
+            return
+
+        if self._smoothed_duration > self._latency_budget:
+            self._frames_over_budget += 1
+            self._frames_under_budget = 0
+        elif self._smoothed_duration < self._latency_budget * self._low_watermark:
+            self._frames_under_budget += 1
+            self._frames_over_budget = 0
+        else:
+            self._frames_over_budget = self._frames_under_budget = 0
+
+        if self._frames_over_budget >= self._patience:
+            self._speed_up(max_index)
+        elif self._frames_under_budget >= self._patience:
+            self._refine()
+
+    def _speed_up(self, max_index: int) -> None:
+        if self._nthreads < self._max_threads:
+            self._nthreads += 1
+        elif self._decimate_index < max_index:
+            self._decimate_index += 1
+        self._reset(self._smoothed_duration)
+
+    def _refine(self) -> None:
+        if self._decimate_index == 0:
+            if self._nthreads > 1:
+                self._nthreads -= 1
+            self._reset(self._smoothed_duration)
+            return
+        # Quad detection cost scales with the number of decimated pixels
+        current = self.QUAD_DECIMATE_LEVELS[self._decimate_index]
+        finer = self.QUAD_DECIMATE_LEVELS[self._decimate_index - 1]
+        predicted = self._smoothed_duration * (current / finer) ** 2
+        if predicted < self._latency_budget:
+            self._decimate_index -= 1
+            self._reset(predicted)
+        else:
+            self._frames_under_budget = 0
+
+    def _max_decimate_index(
+        self, corners_by_uid: Mapping[MarkerId, npt.NDArray[np.float64]]
+    ) -> int:
+        corners = np.asarray(list(corners_by_uid.values()))
+        sides = np.linalg.norm(corners - np.roll(corners, 1, axis=1), axis=2)
+        smallest_side = sides.min()
+        max_index = 0
+        for index, quad_decimate in enumerate(self.QUAD_DECIMATE_LEVELS):
+            if smallest_side / quad_decimate >= self._min_decimated_marker_size:
+                max_index = index
+        return max_index
+
+    def _reset(self, smoothed_duration: float) -> None:
+        self._smoothed_duration = smoothed_duration
+        self._frames_over_budget = self._frames_under_budget = 0
+
+
+class SurfaceLocationHistory:
+    """Ring buffer of the surface locations of the most recent frames, by timestamp.
+
+    Surfaces are stored as their corners in undistorted image coordinates, which can
+    be interpolated between frames. Written by the frame thread and read by the gaze
+    thread.
+    """
+
+    # Corners of the surface in normalized surface coordinates
+    SURFACE_CORNERS = np.array([[0.0, 0.0], [1.0, 0.0], [1.0, 1.0], [0.0, 1.0]])
+
+    def __init__(self, capacity: int = 8, max_extrapolation: float = 0.1):
+        """
+        :param max_extrapolation: Gaze newer than the most recent frame is mapped
+            with the surface location extrapolated by at most this many seconds
+        """
+        self._capacity = capacity
+        self._max_extrapolation = max_extrapolation
+        self._timestamps = np.full(capacity, np.nan)
+        self._corners: Dict[SurfaceId, npt.NDArray[np.float64]] = {}
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def add(
+        self,
+        timestamp: float,
+        surface_locations: Mapping[SurfaceId, Optional[SurfaceLocation]],
+    ) -> None:
+        with self._lock:
+            newest = (self._count - 1) % self._capacity
+            if self._count and timestamp == self._timestamps[newest]:
+                # Replace a frame with a repeated timestamp instead of adding a
+                # zero-duration interval
+                index = newest
+            else:
+                index = self._count % self._capacity
+                self._count += 1
+            self._timestamps[index] = timestamp
+            for surface_uid, location in surface_locations.items():
+                corners = self._corners.get(surface_uid)
+                if corners is None:
+                    corners = np.full((self._capacity, 4, 2), np.nan)
+                    self._corners[surface_uid] = corners
+                if location is None:
+                    corners[index] = np.nan
+                else:
+                    corners[index] = location._map_from_surface_to_image(
+                        self.SURFACE_CORNERS
+                    )
+
+    def map_gaze(
+        self,
+        timestamps: npt.NDArray[np.float64],
+        gaze_undistorted: npt.NDArray[np.float64],
+    ) -> Dict[SurfaceId, "SurfaceGazeColumns"]:
+        """Map undistorted gaze to every surface located in the most recent frame"""
+        with self._lock:
+            if not self._count:
+                return {}
+            newest = (self._count - 1) % self._capacity
+            order = np.argsort(self._timestamps)[: min(self._count, self._capacity)]
+            frame_timestamps = self._timestamps[order]
+            corners_by_uid = {
+                surface_uid: corners[order]
+                for surface_uid, corners in self._corners.items()
+            }
+            newest_located = {
+                surface_uid: not np.isnan(corners[newest, 0, 0])
+                for surface_uid, corners in self._corners.items()
+            }
+
+        mapped_gaze = {}
+        for surface_uid, corners in corners_by_uid.items():
+            if not newest_located[surface_uid] or not len(timestamps):
+                mapped_gaze[surface_uid] = _EMPTY_SURFACE_GAZE
+                continue
+            located = ~np.isnan(corners[:, 0, 0])
+            quads = self._interpolate_corners(
+                timestamps, frame_timestamps[located], corners[located]
+            )
+            norm_pos = _apply_homographies(
+                _homographies_to_unit_square(quads), gaze_undistorted
+            )
+            mapped_gaze[surface_uid] = SurfaceGazeColumns.from_norm_pos(
+                timestamps, norm_pos
+            )
+        return mapped_gaze
+
+    def _interpolate_corners(
+        self,
+        timestamps: npt.NDArray[np.float64],
+        frame_timestamps: npt.NDArray[np.float64],
+        corners: npt.NDArray[np.float64],
+    ) -> npt.NDArray[np.float64]:
+        """Surface corners at each timestamp (Nx4x2) from sorted frame corners"""
+        if len(frame_timestamps) == 1:
+            return np.repeat(corners, len(timestamps), axis=0)
+        timestamps = np.clip(
+            timestamps,
+            frame_timestamps[0] - self._max_extrapolation,
+            frame_timestamps[-1] + self._max_extrapolation,
+        )
+        # Interpolate between the enclosing frames, extrapolate from the outer ones
+        after = np.searchsorted(frame_timestamps, timestamps)
+        after = np.clip(after, 1, len(frame_timestamps) - 1)
+        before = after - 1
+        duration = frame_timestamps[after] - frame_timestamps[before]
+        # Frames with equal timestamps use the corners of the earlier frame
+        weight = np.divide(
+            timestamps - frame_timestamps[before],
+            duration,
+            out=np.zeros_like(timestamps),
+            where=duration > 0,
+        )
+        weight = weight[:, None, None]
+        return corners[before] + (corners[after] - corners[before]) * weight
+
+
+def _homographies_to_unit_square(
+    quads: npt.NDArray[np.float64],
+) -> npt.NDArray[np.float64]:
+    """Homographies (Nx3x3) mapping each quad (Nx4x2) to `SURFACE_CORNERS`"""
+    target = SurfaceLocationHistory.SURFACE_CORNERS
+    x, y = quads[..., 0], quads[..., 1]
+    u, v = target[:, 0], target[:, 1]
+    zeros, ones = np.zeros_like(x), np.ones_like(x)
+    # Two rows of the direct linear transform per correspondence, with h33 = 1
+    rows_u = np.stack((x, y, ones, zeros, zeros, zeros, -u * x, -u * y), axis=-1)
+    rows_v = np.stack((zeros, zeros, zeros, x, y, ones, -v * x, -v * y), axis=-1)
+    A = np.concatenate((rows_u, rows_v), axis=1)
+    b = np.concatenate((np.broadcast_to(u, x.shape), np.broadcast_to(v, x.shape)), 1)
+    h = np.linalg.solve(A, b[..., None])[..., 0]
+    return np.concatenate((h, np.ones((len(h), 1))), axis=1).reshape((-1, 3, 3))
+
+
+def _apply_homographies(
+    homographies: npt.NDArray[np.float64], points: npt.NDArray[np.float64]
+) -> npt.NDArray[np.float64]:
+    """Transform each point (Nx2) with its own homography (Nx3x3)"""
+    points = np.concatenate((points, np.ones((len(points), 1))), axis=1)
+    projected = np.einsum("nij,nj->ni", homographies, points)
+    return projected[:, :2] / projected[:, 2:]
+
+
+class MarkerFlowTracker:
+    """Propagates detected marker corners between frames with pyramidal Lucas-Kanade
+    optical flow.
+
+    `track` returns `None` whenever a full marker detection is required: when the
+    keyframe interval expired, the forward-backward flow error exceeds
+    `max_flow_error` or any corner moved more than `max_motion` pixels.
+    """
+
+    def __init__(
+        self,
+        keyframe_interval: int = 5,
+        max_motion: float = 20.0,
+        max_flow_error: float = 1.0,
+        win_size: Tuple[int, int] = (21, 21),
+        max_level: int = 3,
+    ):
+        self._keyframe_interval = keyframe_interval
+        self._max_motion = max_motion
+        self._max_flow_error = max_flow_error
+        self._lk_params = dict(
+            winSize=win_size,
+            maxLevel=max_level,
+            criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, 0.03),
+        )
+        self._previous_gray: Optional[npt.NDArray[np.uint8]] = None
+        self._corners: Dict[MarkerId, npt.NDArray[np.float64]] = {}
+        self._frames_since_keyframe = 0
+
+    def set_keyframe(
+        self,
+        gray: npt.NDArray[np.uint8],
+        corners_by_uid: Mapping[MarkerId, npt.NDArray[np.float64]],
+    ) -> None:
+        self._store_previous_gray(gray)
+        self._corners = dict(corners_by_uid)
+        self._frames_since_keyframe = 0
+
+    def track(
+        self, gray: npt.NDArray[np.uint8]
+    ) -> Optional[Dict[MarkerId, npt.NDArray[np.float64]]]:
+        if (
+            self._previous_gray is None
+            or not self._corners
+            or self._frames_since_keyframe >= self._keyframe_interval
+            or self._previous_gray.shape != gray.shape
+        ):
+            return None
+
+        uids = list(self._corners)
+        previous = np.concatenate([self._corners[uid] for uid in uids])
+        previous = previous.astype(np.float32).reshape((-1, 1, 2))
+
+        current, status, _ = cv2.calcOpticalFlowPyrLK(
+            self._previous_gray, gray, previous, None, **self._lk_params
+        )
+        backward, status_back, _ = cv2.calcOpticalFlowPyrLK(
+            gray, self._previous_gray, current, None, **self._lk_params
+        )
+        if not (status.all() and status_back.all()):
+            return None
+
+        flow_error = np.linalg.norm(backward - previous, axis=-1).max()
+        motion = np.linalg.norm(current - previous, axis=-1).max()
+        if flow_error > self._max_flow_error or motion > self._max_motion:
+            return None
+
+        current = current.reshape((-1, 4, 2)).astype(np.float64)
+        self._store_previous_gray(gray)
+        self._corners = dict(zip(uids, current))
+        self._frames_since_keyframe += 1
+        return dict(self._corners)
+
+    def _store_previous_gray(self, gray: npt.NDArray[np.uint8]) -> None:
+        # Copy into an own buffer; the caller may reuse `gray` for the next frame
+        if self._previous_gray is None or self._previous_gray.shape != gray.shape:
+            self._previous_gray = np.empty_like(gray)
+        np.copyto(self._previous_gray, gray)
+
+
 class _CoreSurface(Surface):
 
     version = 1
@@ -0,0 +1,281 @@
+"""Re-process a recorded session without a device.
+
+Streams the frames of a scene video through the `MarkerMapper` together with the gaze
+samples recorded between consecutive frames and writes the mapped gaze and surface
+locations to columnar files (CSV, or Parquet if `pyarrow` is installed).
+
+    python marker_mapper_offline.py scene.mp4 world_timestamps.csv gaze.csv \\
+        intrinsics.<SCENE CAMERA SERIAL>.json --output-dir mapped/
+
+Timestamps and gaze are read from the Pupil Cloud CSV exports (`timestamp [ns]`,
+`gaze x [px]`, `gaze y [px]` and `worn` columns). Scene timestamps may also be passed
+as a `.npy` file of timestamps in seconds.
+"""
+import argparse
+import csv
+import os
+import queue
+import threading
+from typing import Dict, Iterator, List, Sequence
+
+import cv2
+import numpy as np
+import numpy.typing as npt
+
+import marker_mapper_lib
+import utils_cloud_api
+from marker_mapper_lib import GazeColumns
+from marker_mapper_parallel import ParallelMarkerMapper
+
+MAPPED_GAZE_COLUMNS = [
+    "frame_index",
+    "timestamp",
+    "aoi_id",
+    "aoi_name",
+    "x",
+    "y",
+    "is_on_aoi",
+]
+SURFACE_LOCATION_COLUMNS = [
+    "frame_index",
+    "timestamp",
+    "aoi_id",
+    "aoi_name",
+    "located",
+    "top_left_x",
+    "top_left_y",
+    "top_right_x",
+    "top_right_y",
+    "bottom_right_x",
+    "bottom_right_y",
+    "bottom_left_x",
+    "bottom_left_y",
+]
+
+# Surface corners in normalized surface coordinates, in the order of the columns above
+_SURFACE_CORNERS = np.array([[0.0, 1.0], [1.0, 1.0], [1.0, 0.0], [0.0, 0.0]])
+
+
+def load_timestamps(path: str) -> npt.NDArray[np.float64]:
+    if path.endswith(".npy"):
+        return np.load(path).astype(np.float64)
+    columns = _read_csv_columns(path, ["timestamp [ns]"])
+    return columns["timestamp [ns]"].astype(np.float64) * 1e-9
+
+
+def load_gaze(path: str) -> GazeColumns:
+    columns = _read_csv_columns(
+        path, ["timestamp [ns]", "gaze x [px]", "gaze y [px]"], optional=["worn"]
+    )
+    timestamps = columns["timestamp [ns]"].astype(np.float64) * 1e-9
+    worn = columns.get("worn")
+    return GazeColumns(
+        timestamps=timestamps,
+        x=columns["gaze x [px]"].astype(np.float64),
+        y=columns["gaze y [px]"].astype(np.float64),
+        worn=np.ones_like(timestamps, dtype=bool) if worn is None else worn,
+    )
+
+
+def gaze_per_frame(
+    frame_timestamps: npt.NDArray[np.float64], gaze: GazeColumns
+) -> Iterator[GazeColumns]:
+    """Yield the gaze samples recorded between each frame and the next one"""
+    bounds = np.searchsorted(gaze.timestamps, frame_timestamps)
+    bounds = np.append(bounds, len(gaze.timestamps))
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        yield gaze.slice(start, stop)
+
+
+def read_frames(path: str, prefetch: int = 32) -> Iterator[npt.NDArray[np.uint8]]:
+    """Decode video frames on a background thread, up to `prefetch` frames ahead"""
+    frames: "queue.Queue[npt.NDArray[np.uint8]]" = queue.Queue(maxsize=prefetch)
+
+    def decode():
+        capture = cv2.VideoCapture(path)
+        try:
+            while True:
+                success, frame = capture.read()
+                if not success:
+                    break
+                frames.put(frame)
+        finally:
+            capture.release()
+            frames.put(None)
+
+    threading.Thread(target=decode, name="FrameDecoder", daemon=True).start()
+    while True:
+        frame = frames.get()
+        if frame is None:
+            return
+        yield frame
+
+
+class ColumnarWriter:
+    """Appends rows to a CSV or Parquet file, flushing every `chunk_size` rows"""
+
+    def __init__(self, path: str, columns: Sequence[str], chunk_size: int = 10000):
+        self._path = path
+        self._columns = list(columns)
+        self._chunk_size = chunk_size
+        self._rows: List[tuple] = []
+        self._is_parquet = path.endswith(".parquet")
+        self._parquet_writer = None
+
+        if self._is_parquet:
+            import pyarrow.parquet  # optional dependency
+
+            self._pyarrow_parquet = pyarrow.parquet
+        else:
+            self._fh = open(path, "w", newline="")
+            self._csv_writer = csv.writer(self._fh)
+            self._csv_writer.writerow(self._columns)
+
+    def append(self, row: tuple) -> None:
+        self._rows.append(row)
+        if len(self._rows) >= self._chunk_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._rows:
+            return
+        if self._is_parquet:
+            import pyarrow
+
+            columns = list(zip(*self._rows))
+            table = pyarrow.table(
+                {name: list(values) for name, values in zip(self._columns, columns)}
+            )
+            if self._parquet_writer is None:
+                self._parquet_writer = self._pyarrow_parquet.ParquetWriter(
+                    self._path, table.schema
+                )
+            self._parquet_writer.write_table(table)
+        else:
+            self._csv_writer.writerows(self._rows)
+        self._rows = []
+
+    def close(self) -> None:
+        self.flush()
+        if self._is_parquet:
+            if self._parquet_writer is not None:
+                self._parquet_writer.close()
+        else:
+            self._fh.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("scene_video")
+    parser.add_argument("scene_timestamps")
+    parser.add_argument("gaze")
+    parser.add_argument("intrinsics", help="intrinsics.<serial>.json cache file")
+    parser.add_argument(
+        "--surface-definitions",
+        default="~/pupil_capture_settings/surface_definitions_v01",
+    )
+    parser.add_argument("--output-dir", default=".")
+    parser.add_argument("--format", choices=("csv", "parquet"), default="csv")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="process frames in parallel on this many worker processes",
+    )
+    args = parser.parse_args()
+
+    camera = utils_cloud_api.camera_from_intrinsics_file(args.intrinsics)
+    mapper = marker_mapper_lib.MarkerMapper(camera)
+    mapper.add_core_surface_definitions_from_file(args.surface_definitions)
+    surface_name_by_uid: Dict[str, str] = {s.uid: s.name for s in mapper.surfaces}
+
+    frame_timestamps = load_timestamps(args.scene_timestamps)
+    frames_and_gaze = zip(
+        read_frames(args.scene_video),
+        gaze_per_frame(frame_timestamps, load_gaze(args.gaze)),
+    )
+
+    parallel_mapper = None
+    if args.workers > 1:
+        parallel_mapper = ParallelMarkerMapper(
+            camera, args.surface_definitions, num_workers=args.workers
+        )
+        results = parallel_mapper.map(frames_and_gaze)
+    else:
+        results = (mapper.process_frame_columnar(f, g) for f, g in frames_and_gaze)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    gaze_writer = ColumnarWriter(
+        os.path.join(args.output_dir, f"mapped_gaze.{args.format}"),
+        MAPPED_GAZE_COLUMNS,
+    )
+    location_writer = ColumnarWriter(
+        os.path.join(args.output_dir, f"surface_locations.{args.format}"),
+        SURFACE_LOCATION_COLUMNS,
+    )
+    try:
+        for frame_index, result in enumerate(results):
+            if result is None:
+                continue
+            frame_ts = frame_timestamps[frame_index]
+            for aoi_id, location in result.located_aois.items():
+                name = surface_name_by_uid.get(aoi_id, "")
+                if location is None:
+                    corners = [np.nan] * 8
+                else:
+                    corners = location._map_from_surface_to_image(_SURFACE_CORNERS)
+                    corners = camera.distort_points_on_image_plane(corners)
+                    corners = corners.ravel().tolist()
+                location_writer.append(
+                    (frame_index, frame_ts, aoi_id, name, location is not None, *corners)
+                )
+                gaze = result.gaze[aoi_id]
+                for timestamp, x, y, is_on_aoi in zip(
+                    gaze.timestamps.tolist(),
+                    gaze.x.tolist(),
+                    gaze.y.tolist(),
+                    gaze.is_on_aoi.tolist(),
+                ):
+                    gaze_writer.append(
+                        (frame_index, timestamp, aoi_id, name, x, y, is_on_aoi)
+                    )
+            if frame_index % 1000 == 0:
+                print(f"Processed {frame_index} / {len(frame_timestamps)} frames")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        gaze_writer.close()
+        location_writer.close()
+        if parallel_mapper is not None:
+            parallel_mapper.close()
+
+
+def _read_csv_columns(
+    path: str, names: Sequence[str], optional: Sequence[str] = ()
+) -> Dict[str, npt.NDArray]:
+    with open(path, newline="") as fh:
+        reader = csv.reader(fh)
+        header = next(reader)
+        missing = [name for name in names if name not in header]
+        if missing:
+            raise ValueError(f"{path} is missing the columns {missing}")
+        indices = {
+            name: header.index(name)
+            for name in [*names, *optional]
+            if name in header
+        }
+        rows = [[row[i] for i in indices.values()] for row in reader]
+    values = np.array(rows, dtype=object).reshape((-1, len(indices)))
+    columns = {}
+    for column, name in enumerate(indices):
+        if name == "worn":
+            columns[name] = np.array(
+                [v.lower() in ("1", "1.0", "true") for v in values[:, column]]
+            )
+        else:
+            columns[name] = values[:, column].astype(np.float64)
+    return columns
+
+
+if __name__ == "__main__":
+    main()
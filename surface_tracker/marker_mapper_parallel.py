@@ -0,0 +1,200 @@
+import collections
+import concurrent.futures
+import multiprocessing
+import os
+import sys
+from multiprocessing import resource_tracker, shared_memory
+from typing import (
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+import numpy as np
+import numpy.typing as npt
+from pupil_labs.realtime_api import GazeData
+
+import marker_mapper_lib
+from marker_mapper_lib import (
+    ColumnarMarkerMapperResult,
+    GazeColumns,
+    MarkerMapperResult,
+    RadialDistorsionCamera,
+)
+
+
+class ParallelMarkerMapper:
+    """Shards frames across a pool of worker processes, each owning its own detector,
+    camera model and surfaces.
+
+    Frames are copied into shared memory slots instead of being pickled; only the
+    small gaze lists and the results cross the process boundary. Results are yielded
+    in input order.
+
+    Since consecutive frames are processed by different workers, stateful detector
+    options like `roi_tracking` only see every n-th frame and should not be used.
+    Each worker runs a single-threaded detector unless `nthreads` is given.
+    """
+
+    def __init__(
+        self,
+        camera: RadialDistorsionCamera,
+        surface_definitions_path: Optional[str] = None,
+        num_workers: Optional[int] = None,
+        frames_in_flight_per_worker: int = 2,
+        **mapper_options,
+    ) -> None:
+        num_workers = num_workers or os.cpu_count() or 1
+        # The workers already use every core
+        mapper_options.setdefault("nthreads", 1)
+        # Forking is unsafe once the caller started threads, e.g. a decoder thread
+        start_method = (
+            "forkserver"
+            if "forkserver" in multiprocessing.get_all_start_methods()
+            else "spawn"
+        )
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context(start_method),
+            initializer=_init_worker,
+            initargs=(
+                camera.K,
+                camera.D,
+                camera.cache_prefix,
+                surface_definitions_path,
+                mapper_options,
+            ),
+        )
+        self._num_slots = num_workers * frames_in_flight_per_worker
+        self._slots: List[shared_memory.SharedMemory] = []
+        self._free_slots: List[int] = []
+
+    def map(
+        self,
+        frames_and_gaze: Iterable[
+            Tuple[npt.NDArray[np.uint8], Union[GazeColumns, Sequence[GazeData]]]
+        ],
+    ) -> Iterator[Union[ColumnarMarkerMapperResult, MarkerMapperResult, None]]:
+        """Gaze given as `GazeColumns` yields `ColumnarMarkerMapperResult`s"""
+        pending: Deque[Tuple[concurrent.futures.Future, int]] = collections.deque()
+        try:
+            for frame, gaze in frames_and_gaze:
+                if not self._slots:
+                    self._allocate_slots(frame.nbytes)
+                if frame.nbytes > self._slots[0].size:
+                    raise ValueError(
+                        f"Frame of {frame.nbytes} bytes does not fit into shared "
+                        f"memory slots of {self._slots[0].size} bytes"
+                    )
+
+                if not self._free_slots:
+                    yield self._release_slot(*pending.popleft())
+
+                slot = self._free_slots.pop()
+                shm = self._slots[slot]
+                np.ndarray(frame.shape, frame.dtype, buffer=shm.buf)[...] = frame
+                future = self._executor.submit(
+                    _process_frame_in_worker,
+                    shm.name,
+                    frame.shape,
+                    frame.dtype.str,
+                    gaze if isinstance(gaze, GazeColumns) else list(gaze),
+                )
+                pending.append((future, slot))
+
+            while pending:
+                yield self._release_slot(*pending.popleft())
+        finally:
+            # Results that were not consumed still occupy their slot until computed
+            for future, slot in pending:
+                concurrent.futures.wait((future,))
+                self._free_slots.append(slot)
+
+    def close(self) -> None:
+        self._executor.shutdown()
+        for shm in self._slots:
+            shm.close()
+            shm.unlink()
+        self._slots = []
+        self._free_slots = []
+
+    def __enter__(self) -> "ParallelMarkerMapper":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _allocate_slots(self, nbytes: int) -> None:
+        self._slots = [
+            shared_memory.SharedMemory(create=True, size=nbytes)
+            for _ in range(self._num_slots)
+        ]
+        self._free_slots = list(range(self._num_slots))
+
+    def _release_slot(
+        self, future: concurrent.futures.Future, slot: int
+    ) -> Union[ColumnarMarkerMapperResult, MarkerMapperResult, None]:
+        concurrent.futures.wait((future,))
+        self._free_slots.append(slot)
+        return future.result()
+
+
+# Worker process state
+
+_worker_mapper: Optional[marker_mapper_lib.MarkerMapper] = None
+_worker_slots: Dict[str, shared_memory.SharedMemory] = {}
+
+
+def _init_worker(
+    K: npt.NDArray[np.float64],
+    D: npt.NDArray[np.float64],
+    cache_prefix: Optional[str],
+    surface_definitions_path: Optional[str],
+    mapper_options: dict,
+) -> None:
+    global _worker_mapper
+    # Workers share the memory-mapped undistortion tables through the page cache
+    camera = RadialDistorsionCamera(K, D, cache_prefix=cache_prefix)
+    _worker_mapper = marker_mapper_lib.MarkerMapper(camera, **mapper_options)
+    if surface_definitions_path:
+        _worker_mapper.add_core_surface_definitions_from_file(surface_definitions_path)
+
+
+def _process_frame_in_worker(
+    shm_name: str,
+    shape: Tuple[int, ...],
+    dtype: str,
+    gaze: Union[GazeColumns, List[GazeData]],
+) -> Union[ColumnarMarkerMapperResult, MarkerMapperResult, None]:
+    shm = _worker_slots.get(shm_name)
+    if shm is None:
+        shm = _worker_slots[shm_name] = _attach_untracked(shm_name)
+    frame = np.ndarray(shape, np.dtype(dtype), buffer=shm.buf)
+    if isinstance(gaze, GazeColumns):
+        return _worker_mapper.process_frame_columnar(frame, gaze)
+    return _worker_mapper.process_frame(frame, gaze)
+
+
+def _attach_untracked(shm_name: str) -> shared_memory.SharedMemory:
+    """Attach to a slot without registering it with the resource tracker.
+
+    The parent process owns and unlinks the slot, and the workers share its resource
+    tracker. A registration from a worker would be removed by the parent's unlink,
+    while unregistering in the worker would remove the parent's registration.
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=shm_name, track=False)
+    # Before Python 3.13, attaching always registers the segment. Workers run one
+    # task at a time, so the registration can be skipped for the duration.
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=shm_name)
+    finally:
+        resource_tracker.register = register
@@ -1,31 +1,398 @@
 import nest_asyncio
 nest_asyncio.apply()
 
+import argparse
 import asyncio
+import concurrent.futures
+import functools
+import http
+import itertools
 import json
+import logging
+import os
+import time
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
 import websockets
-from marker_mapper import MarkerMapper
+from websockets.asyncio.server import ServerConnection, serve
+from websockets.http11 import Request, Response
+
+import gaze_protocol
+from gaze_keyboard import DwellKeyboard, KeyboardLayout
+from marker_mapper import (
+    SURFACE_DEFINITIONS_PATH,
+    MarkerMapper,
+    MarkerMapperWorker,
+    ResultBroadcaster,
+    discover_scene_camera_devices,
+)
+from marker_mapper_async import AsyncMarkerMapper, discover_devices
+from utils_metrics import ConnectionLatency, connection_latency_prometheus
+from utils_startup import preload_pipeline
+
+_connection_ids = itertools.count()
+# Seconds between gaze cursor positions sent alongside key events
+CURSOR_INTERVAL = 1 / 30
+# Seconds to wait on shutdown for a worker to stop and write its recording
+WORKER_STOP_TIMEOUT = 5.0
+
+
+class ClientSession:
+    def __init__(self, binary: bool):
+        self.binary = binary
+        self.connection_id = str(next(_connection_ids))
+        self.latency = ConnectionLatency()
+        # Set once the client sent its keyboard layout; then key events are sent,
+        # together with the gaze cursor position at a reduced rate
+        self.keyboard: Optional[DwellKeyboard] = None
+        self.keyboard_aoi_id: Optional[str] = None
+        self.cursor_sent = -float("inf")
+
+
+async def handler(
+    websocket: ServerConnection,
+    broadcasters: Dict[str, ResultBroadcaster],
+    connections: Dict[str, Dict[str, ConnectionLatency]],
+):
+    # Connections to the same device share its pipeline; unknown paths were
+    # already rejected by process_request()
+    device_id, _ = parse_path(websocket.request.path, broadcasters)
+    broadcaster = broadcasters[device_id]
+    session = ClientSession(
+        binary=websocket.subprotocol == gaze_protocol.BINARY_SUBPROTOCOL
+    )
+    connections[device_id][session.connection_id] = session.latency
+    with broadcaster.subscribe() as results:
+        receiver = asyncio.ensure_future(receive_messages(websocket, session))
+        try:
+            await send_results(websocket, results, session)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            receiver.cancel()
+            try:
+                await receiver
+            except (asyncio.CancelledError, websockets.ConnectionClosed):
+                pass
+            except Exception:
+                logging.exception(f"Connection {session.connection_id} failed")
+            del connections[device_id][session.connection_id]
+            log_latency(session)
+
 
+async def receive_messages(websocket, session: ClientSession):
+    async for message in websocket:
+        try:
+            message = json.loads(message)
+            if message.get("type") == "ack":
+                session.latency.observe_acknowledged(
+                    float(message["timestamp"]), time.time()
+                )
+            elif message.get("type") == "layout":
+                session.keyboard = DwellKeyboard(
+                    KeyboardLayout.from_dict(message),
+                    dwell_duration=float(message.get("dwell_duration", 1.0)),
+                )
+                session.keyboard_aoi_id = message.get("aoi_id")
+        except (ValueError, AttributeError, KeyError, TypeError) as err:
+            logging.warning(f"Ignoring invalid client message: {err}")
 
 
-async def handler(websocket):
-    mapper = MarkerMapper()
+async def send_results(websocket, results: asyncio.Queue, session: ClientSession):
     while True:
-        result = mapper()
-        result = list(result.mapped_gaze.values())[0]
-        if len(result) > 0:
-            await asyncio.sleep(0.1)
-            point = {"x": result[0].x, "y": result[0].y}
-            # point = {"x": 200, "y": 200}
-            print("Sending: ", point)
-            await websocket.send(json.dumps(point))
+        # Batch everything that queued up while the previous message was sent
+        batch = [await results.get()]
+        while not results.empty():
+            batch.append(results.get_nowait())
+
+        # Clients acknowledge the gaze timestamps they received
+        gaze_timestamps = []
+        if session.keyboard is not None:
+            gaze = list(keyboard_gaze(batch, session.keyboard_aoi_id))
+            for event in session.keyboard.update(gaze):
+                await websocket.send(json.dumps(event._asdict()))
+                gaze_timestamps.append(event.timestamp)
+            now = time.monotonic()
+            if gaze and now - session.cursor_sent >= CURSOR_INTERVAL:
+                point = gaze_protocol.encode_json(gaze[-1])
+                await websocket.send(json.dumps(point))
+                gaze_timestamps.append(point["timestamp"])
+                session.cursor_sent = now
+        elif session.binary:
+            records = gaze_protocol.mapped_gaze_records(batch)
+            if records:
+                await websocket.send(gaze_protocol.encode_binary(records))
+                gaze_timestamps.append(records[-1].base_datum.timestamp_unix_seconds)
+        else:
+            result = next(iter(batch[-1].mapped_gaze.values()), [])
+            if len(result) > 0:
+                point = gaze_protocol.encode_json(result[0])
+                await websocket.send(json.dumps(point))
+                gaze_timestamps.append(point["timestamp"])
+        if gaze_timestamps:
+            session.latency.observe_sent(
+                batch[-1].stage_timestamps or {}, time.time(), gaze_timestamps
+            )
+
+
+def log_latency(session: ClientSession):
+    browser = session.latency.stages["browser"].quantiles()
+    sent = session.latency.stages["sent"].quantiles()
+    logging.info(
+        f"Connection {session.connection_id} closed; glass-to-browser latency "
+        f"p50={browser[0.5]:.3f}s p99={browser[0.99]:.3f}s, "
+        f"glass-to-sent p50={sent[0.5]:.3f}s p99={sent[0.99]:.3f}s"
+    )
+
+
+def keyboard_gaze(batch, aoi_id: Optional[str]):
+    for result in batch:
+        if aoi_id is None:
+            mapped_gaze = next(iter(result.mapped_gaze.values()), [])
+        else:
+            mapped_gaze = result.mapped_gaze.get(aoi_id, [])
+        yield from mapped_gaze
+
+
+def parse_path(path: str, device_ids: Iterable[str]) -> Tuple[Optional[str], str]:
+    """Split a request path into the addressed device id and resource.
+
+    `/<device id>/<resource>` addresses a device explicitly; paths without a known
+    device id address the first device, so single-device clients keep working.
+    """
+    device_ids = list(device_ids)
+    parts = [part for part in path.split("?")[0].split("/") if part]
+    if parts and parts[0] in device_ids:
+        return parts[0], "/".join(parts[1:])
+    if device_ids:
+        return device_ids[0], "/".join(parts)
+    return None, "/".join(parts)
+
+
+def process_request(
+    connection: ServerConnection,
+    request: Request,
+    mappers: Dict[str, Union[MarkerMapper, AsyncMarkerMapper]],
+    connections: Dict[str, Dict[str, ConnectionLatency]],
+) -> Optional[Response]:
+    device_id, resource = parse_path(request.path, mappers)
+    if resource == "devices":
+        body = json.dumps([mapper.describe() for mapper in mappers.values()])
+        return respond(connection, http.HTTPStatus.OK, body, "application/json")
+    if resource == "metrics":
+        # Serve Prometheus metrics over plain HTTP on the websocket port
+        body = mappers[device_id].metrics.to_prometheus()
+        body += connection_latency_prometheus(connections[device_id])
+        content_type = "text/plain; version=0.0.4; charset=utf-8"
+        return respond(connection, http.HTTPStatus.OK, body, content_type)
+    if resource:
+        return connection.respond(
+            http.HTTPStatus.NOT_FOUND, f"Not found: {request.path}\n"
+        )
+    return None
+
+
+def respond(
+    connection: ServerConnection, status: http.HTTPStatus, body: str, content_type: str
+) -> Response:
+    response = connection.respond(status, body)
+    del response.headers["Content-Type"]
+    response.headers["Content-Type"] = content_type
+    return response
+
+
+async def main(
+    full_rate_gaze: bool = False,
+    record_to: Optional[str] = None,
+    max_devices: int = 1,
+    async_ingest: bool = False,
+    gaze_tolerance: float = 1 / 60,
+    smooth_gaze: bool = False,
+):
+    # Latency reports of closed connections are logged at INFO
+    logging.basicConfig(level=logging.INFO)
+    loop = asyncio.get_running_loop()
+    surfaces = preload_pipeline(SURFACE_DEFINITIONS_PATH)
+    if async_ingest:
+        mappers = await start_async_mappers(
+            surfaces, record_to, max_devices, gaze_tolerance, smooth_gaze
+        )
+    else:
+        mappers = await start_mappers(
+            surfaces, full_rate_gaze, record_to, max_devices, smooth_gaze
+        )
+    if not mappers:
+        print("No device found.")
+        raise SystemExit(-1)
+    for device_id, mapper in mappers.items():
+        print(f"Serving {mapper.describe()['name']} at /{device_id}")
+
+    broadcasters: Dict[str, ResultBroadcaster] = {}
+    connections = {device_id: {} for device_id in mappers}
+    workers: List[MarkerMapperWorker] = []
+    tasks: List[asyncio.Future] = []
+    for device_id, mapper in mappers.items():
+        broadcasters[device_id] = ResultBroadcaster(loop, metrics=mapper.metrics)
+        if async_ingest:
+            task = asyncio.ensure_future(mapper.run(broadcasters[device_id].publish))
+            tasks.append(task)
+        else:
+            workers.append(MarkerMapperWorker(mapper, broadcasters[device_id].publish))
+    for worker in workers:
+        worker.start()
+
+    try:
+        async with serve(
+            functools.partial(
+                handler, broadcasters=broadcasters, connections=connections
+            ),
+            "",
+            8001,
+            subprotocols=gaze_protocol.SUBPROTOCOLS,
+            process_request=functools.partial(
+                process_request, mappers=mappers, connections=connections
+            ),
+        ):
+            await asyncio.Future()  # run forever
+    finally:
+        for worker in workers:
+            worker.stop()
+        for worker in workers:
+            worker.join_or_close(WORKER_STOP_TIMEOUT)
+        for task in tasks:
+            task.cancel()
+        # The tasks close their devices and recorders when cancelled
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def start_mappers(
+    surfaces: "concurrent.futures.Future",
+    full_rate_gaze: bool,
+    record_to: Optional[str],
+    max_devices: int,
+    smooth_gaze: bool,
+) -> Dict[str, MarkerMapper]:
+    loop = asyncio.get_running_loop()
+    # Device discovery may take several seconds; keep it off the event loop
+    devices = await loop.run_in_executor(
+        None, discover_scene_camera_devices, max_devices
+    )
+    surfaces = await asyncio.wrap_future(surfaces)
+
+    # Every device gets its own camera model, detector and capture thread. OpenCV
+    # and the AprilTag detector release the GIL, so the pipelines run in parallel.
+    mappers = await asyncio.gather(
+        *(
+            loop.run_in_executor(
+                None,
+                functools.partial(
+                    MarkerMapper,
+                    full_rate_gaze=full_rate_gaze,
+                    record_to=device_recording_path(
+                        record_to, device.phone_id, len(devices)
+                    ),
+                    device=device,
+                    surfaces=surfaces,
+                    smooth_gaze=smooth_gaze,
+                ),
+            )
+            for device in devices
+        )
+    )
+    return {mapper.device_id: mapper for mapper in mappers}
+
+
+async def start_async_mappers(
+    surfaces: "concurrent.futures.Future",
+    record_to: Optional[str],
+    max_devices: int,
+    gaze_tolerance: float,
+    smooth_gaze: bool,
+) -> Dict[str, AsyncMarkerMapper]:
+    devices = await discover_devices(max_devices)
+    surfaces = await asyncio.wrap_future(surfaces)
+
+    async def connect(device):
+        status = await device.get_status()
+        return await AsyncMarkerMapper.connect(
+            device,
+            surfaces,
+            record_to=device_recording_path(
+                record_to, status.phone.device_id, len(devices)
+            ),
+            tolerance=gaze_tolerance,
+            smooth_gaze=smooth_gaze,
+        )
+
+    mappers = {}
+    for mapper in await asyncio.gather(
+        *(connect(device) for device in devices), return_exceptions=True
+    ):
+        if isinstance(mapper, Exception):
+            print(mapper)
+        else:
+            mappers[mapper.device_id] = mapper
+    return mappers
 
 
-async def main():
-    async with websockets.serve(handler, "", 8001):
-        await asyncio.Future()  # run forever
+def device_recording_path(
+    record_to: Optional[str], device_id: str, device_count: int
+) -> Optional[str]:
+    # Keep the recordings of several devices apart
+    if record_to is None or device_count == 1:
+        return record_to
+    return os.path.join(record_to, device_id)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
-    # await main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Stream mapped gaze to clients")
+    parser.add_argument(
+        "--full-rate-gaze",
+        action="store_true",
+        help="Map every gaze sample instead of one sample per scene frame",
+    )
+    parser.add_argument(
+        "--smooth-gaze",
+        action="store_true",
+        help="Smooth mapped gaze with a One Euro filter; reduces jitter, adds lag",
+    )
+    parser.add_argument(
+        "--record",
+        metavar="DIR",
+        help="Record scene frames, gaze and mapper results to DIR for replay",
+    )
+    parser.add_argument(
+        "--devices",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Serve up to N devices, each at ws://<host>:8001/<device id>",
+    )
+    parser.add_argument(
+        "--async-ingest",
+        action="store_true",
+        help="Receive scene video and gaze as separate streams on the event loop and "
+        "map every gaze sample with the scene frame it belongs to",
+    )
+    parser.add_argument(
+        "--gaze-tolerance",
+        type=float,
+        default=1 / 60,
+        metavar="SECONDS",
+        help="With --async-ingest, the maximum time between a gaze sample and its "
+        "scene frame",
+    )
+    args = parser.parse_args()
+    if args.async_ingest and args.full_rate_gaze:
+        parser.error("--full-rate-gaze is not supported with --async-ingest")
+    asyncio.run(
+        main(
+            full_rate_gaze=args.full_rate_gaze,
+            record_to=args.record,
+            max_devices=args.devices,
+            async_ingest=args.async_ingest,
+            gaze_tolerance=args.gaze_tolerance,
+            smooth_gaze=args.smooth_gaze,
+        )
+    )
+    # await main()
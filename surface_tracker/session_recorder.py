@@ -0,0 +1,394 @@
+"""Record what the live pipeline saw, and replay it through `process_frame`.
+
+A recording is a directory with:
+
+    session.json                   camera intrinsics, frame count and dropped frames,
+                                   rewritten with every chunk of frames
+    surfaces.pickle                the surface definitions used by the mapper
+    frames/<frame index>.png       lossless scene frames (every `keyframe_interval`)
+    <table>.<chunk index>.npz      append-only column chunks of the tables below
+
+Tables: `frames`, `gaze` (raw `GazeData`), `markers` (undistorted vertices),
+`surface_locations` (undistorted surface corners) and `mapped_gaze`.
+
+Recording happens on a background thread behind a bounded queue. When the disk falls
+behind, frames are dropped and counted instead of blocking the capture. Recordings
+with all frames stored and no drops replay bit-exactly:
+
+    python session_recorder.py recording/
+"""
+import argparse
+import glob
+import json
+import os
+import pickle
+import queue
+import threading
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+import numpy.typing as npt
+from pupil_labs.realtime_api import GazeData
+
+import marker_mapper_lib
+from marker_mapper import create_mapper
+from utils_metrics import MarkerMapperMetrics
+
+FRAME_COLUMNS = ["frame_index", "timestamp", "has_image"]
+GAZE_COLUMNS = ["frame_index", "timestamp", "x", "y", "worn"]
+MARKER_COLUMNS = ["frame_index", "marker_uid", "vertices"]
+SURFACE_LOCATION_COLUMNS = ["frame_index", "aoi_id", "located", "corners"]
+MAPPED_GAZE_COLUMNS = ["frame_index", "timestamp", "aoi_id", "x", "y", "is_on_aoi"]
+
+
+class SessionRecorder:
+    def __init__(
+        self,
+        directory: str,
+        camera: "marker_mapper_lib.RadialDistorsionCamera",
+        surfaces: Sequence["marker_mapper_lib.Surface"],
+        keyframe_interval: int = 1,
+        chunk_size: int = 1000,
+        max_pending: int = 16,
+        metrics: Optional[MarkerMapperMetrics] = None,
+        smooth_gaze: bool = False,
+        full_rate_gaze: bool = False,
+    ) -> None:
+        """
+        :param keyframe_interval: Store every n-th scene frame; all other tables are
+            recorded for every frame. Bit-exact replay requires every frame.
+        :param max_pending: Frames waiting to be written before new ones are dropped
+        :param smooth_gaze: Whether the recorded mapper smooths gaze, for replay
+        :param full_rate_gaze: Whether gaze is recorded with `record_gaze` instead of
+            together with the frames
+        """
+        self._directory = directory
+        self._keyframe_interval = keyframe_interval
+        self._metrics = metrics
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_pending)
+        self._frame_index = 0
+        self.dropped_frames = 0
+        self.dropped_gaze = 0
+        self._closed = False
+        self._close_lock = threading.Lock()
+        self._session_lock = threading.Lock()
+
+        os.makedirs(os.path.join(directory, "frames"), exist_ok=True)
+        with open(os.path.join(directory, "surfaces.pickle"), "wb") as fh:
+            pickle.dump(list(surfaces), fh, protocol=pickle.HIGHEST_PROTOCOL)
+        self._session = {
+            "K": camera.K.tolist(),
+            "D": camera.D.tolist(),
+            "smooth_gaze": smooth_gaze,
+            "full_rate_gaze": full_rate_gaze,
+        }
+        self._update_session()
+
+        self._tables = {
+            name: _ChunkWriter(os.path.join(directory, name), columns, chunk_size)
+            for name, columns in (
+                ("frames", FRAME_COLUMNS),
+                ("gaze", GAZE_COLUMNS),
+                ("markers", MARKER_COLUMNS),
+                ("surface_locations", SURFACE_LOCATION_COLUMNS),
+                ("mapped_gaze", MAPPED_GAZE_COLUMNS),
+            )
+        }
+        self._thread = threading.Thread(
+            target=self._write, name="SessionRecorder", daemon=True
+        )
+        self._thread.start()
+
+    def record(
+        self,
+        image: npt.NDArray[np.uint8],
+        timestamp: float,
+        gaze: Sequence[GazeData],
+        result: Optional["marker_mapper_lib.MarkerMapperResult"],
+    ) -> None:
+        """Queue a processed frame for writing; never blocks"""
+        frame_index = self._frame_index
+        self._frame_index += 1
+        try:
+            self._queue.put_nowait((frame_index, image, timestamp, list(gaze), result))
+        except queue.Full:
+            self.dropped_frames += 1
+            if self._metrics is not None:
+                self._metrics.observe_dropped_recordings()
+
+    def record_gaze(
+        self,
+        gaze: GazeData,
+        result: Optional["marker_mapper_lib.ColumnarMarkerMapperResult"],
+    ) -> None:
+        """Queue a gaze sample mapped independently of the frames; never blocks.
+
+        The sample is recorded with the index of the most recently recorded frame.
+        """
+        if not self._session["full_rate_gaze"]:
+            with self._session_lock:
+                self._session["full_rate_gaze"] = True
+            self._update_session()
+        frame_index = self._frame_index - 1
+        try:
+            self._queue.put_nowait((frame_index, None, None, [gaze], result))
+        except queue.Full:
+            self.dropped_gaze += 1
+            if self._metrics is not None:
+                self._metrics.observe_dropped_recordings()
+
+    def close(self) -> None:
+        """Write the remaining rows and the final session metadata; idempotent"""
+        with self._close_lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+            self._thread.join()
+            for table in self._tables.values():
+                table.flush()
+            self._update_session()
+
+    def _write(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            frame_index, image, timestamp, gaze, result = item
+
+            # Gaze recorded with `record_gaze` comes without a frame
+            if image is not None:
+                has_image = frame_index % self._keyframe_interval == 0
+                if has_image:
+                    name = f"{frame_index:08d}.png"
+                    path = os.path.join(self._directory, "frames", name)
+                    cv2.imwrite(path, image, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+                if self._tables["frames"].append((frame_index, timestamp, has_image)):
+                    self._update_session()
+            for sample in gaze:
+                self._tables["gaze"].append(
+                    (
+                        frame_index,
+                        sample.timestamp_unix_seconds,
+                        sample.x,
+                        sample.y,
+                        sample.worn,
+                    )
+                )
+            if result is not None:
+                self._write_result(frame_index, result)
+
+    def _write_result(
+        self, frame_index: int, result: "marker_mapper_lib.MarkerMapperResult"
+    ) -> None:
+        for row in _marker_rows(frame_index, result):
+            self._tables["markers"].append(row)
+
+        corners = marker_mapper_lib.SurfaceLocationHistory.SURFACE_CORNERS
+        for aoi_id, location in result.located_aois.items():
+            if location is None:
+                aoi_corners = np.full(8, np.nan)
+            else:
+                aoi_corners = location._map_from_surface_to_image(corners).ravel()
+            self._tables["surface_locations"].append(
+                (frame_index, str(aoi_id), location is not None, aoi_corners)
+            )
+
+        for aoi_id, rows in _mapped_gaze_rows(result).items():
+            for timestamp, x, y, is_on_aoi in rows:
+                self._tables["mapped_gaze"].append(
+                    (frame_index, timestamp, str(aoi_id), x, y, is_on_aoi)
+                )
+
+    def _update_session(self) -> None:
+        """Write the session metadata with the current counts"""
+        with self._session_lock:
+            self._session["frames"] = self._frame_index
+            self._session["dropped_frames"] = self.dropped_frames
+            self._session["dropped_gaze"] = self.dropped_gaze
+            # Replace the file at once, so that it is never left half written
+            path = os.path.join(self._directory, "session.json")
+            with open(path + ".tmp", "w") as fh:
+                json.dump(self._session, fh)
+            os.replace(path + ".tmp", path)
+
+
+class _ChunkWriter:
+    """Buffers rows and writes every `chunk_size` rows to a new `.npz` chunk"""
+
+    def __init__(self, path_prefix: str, columns: Sequence[str], chunk_size: int):
+        self._path_prefix = path_prefix
+        self._columns = list(columns)
+        self._chunk_size = chunk_size
+        self._rows: List[tuple] = []
+        self._chunk_index = 0
+
+    def append(self, row: tuple) -> bool:
+        """Buffer a row; True if this wrote a chunk"""
+        self._rows.append(row)
+        if len(self._rows) >= self._chunk_size:
+            self.flush()
+            return True
+        return False
+
+    def flush(self) -> None:
+        if not self._rows:
+            return
+        path = f"{self._path_prefix}.{self._chunk_index:05d}.npz"
+        np.savez(
+            path,
+            **{
+                name: np.array(values)
+                for name, values in zip(self._columns, zip(*self._rows))
+            },
+        )
+        self._chunk_index += 1
+        self._rows = []
+
+
+def load_table(directory: str, name: str) -> Dict[str, np.ndarray]:
+    """Concatenate all chunks of a recorded table into columns"""
+    chunks = []
+    for path in sorted(glob.glob(os.path.join(directory, f"{name}.*.npz"))):
+        with np.load(path) as chunk:
+            chunks.append({column: chunk[column] for column in chunk.files})
+    if not chunks:
+        return {}
+    return {
+        column: np.concatenate([chunk[column] for chunk in chunks])
+        for column in chunks[0]
+    }
+
+
+def load_session(
+    directory: str,
+) -> Tuple["marker_mapper_lib.RadialDistorsionCamera", list, dict]:
+    """Return the camera, surfaces and session metadata of a recording"""
+    with open(os.path.join(directory, "session.json")) as fh:
+        session = json.load(fh)
+    with open(os.path.join(directory, "surfaces.pickle"), "rb") as fh:
+        surfaces = pickle.load(fh)
+    camera = marker_mapper_lib.RadialDistorsionCamera(session["K"], session["D"])
+    return camera, surfaces, session
+
+
+def read_frames(
+    directory: str,
+) -> Iterator[Tuple[int, float, npt.NDArray[np.uint8], List[GazeData]]]:
+    """Yield (frame index, timestamp, image, gaze) of every stored frame"""
+    frames = load_table(directory, "frames")
+    if not frames:
+        return
+    gaze = load_table(directory, "gaze")
+    gaze_frame_index = gaze.get("frame_index", np.empty(0, dtype=np.int64))
+    bounds = np.searchsorted(gaze_frame_index, frames["frame_index"], side="left")
+    bounds_end = np.searchsorted(gaze_frame_index, frames["frame_index"], side="right")
+
+    for frame_index, timestamp, has_image, start, stop in zip(
+        frames["frame_index"].tolist(),
+        frames["timestamp"].tolist(),
+        frames["has_image"].tolist(),
+        bounds.tolist(),
+        bounds_end.tolist(),
+    ):
+        if not has_image:
+            continue
+        path = os.path.join(directory, "frames", f"{frame_index:08d}.png")
+        image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+        frame_gaze = [
+            GazeData(
+                x=gaze["x"][i],
+                y=gaze["y"][i],
+                worn=bool(gaze["worn"][i]),
+                timestamp_unix_seconds=gaze["timestamp"][i],
+            )
+            for i in range(start, stop)
+        ]
+        yield frame_index, timestamp, image, frame_gaze
+
+
+def _marker_rows(
+    frame_index: int, result: "marker_mapper_lib.MarkerMapperResult"
+) -> List[Tuple[int, str, npt.NDArray[np.float64]]]:
+    return [
+        (
+            frame_index,
+            str(marker.uid),
+            np.asarray(marker.vertices(), dtype=np.float64).ravel(),
+        )
+        for marker in result.markers
+    ]
+
+
+def _mapped_gaze_rows(
+    result: "marker_mapper_lib.MarkerMapperResult",
+) -> Dict[str, List[Tuple[float, float, float, bool]]]:
+    columns = getattr(result, "gaze", None)
+    if columns is not None:
+        return {
+            aoi_id: list(
+                zip(
+                    gaze.timestamps.tolist(),
+                    gaze.x.tolist(),
+                    gaze.y.tolist(),
+                    gaze.is_on_aoi.tolist(),
+                )
+            )
+            for aoi_id, gaze in columns.items()
+        }
+    return {
+        aoi_id: [
+            (g.base_datum.timestamp_unix_seconds, g.x, g.y, g.is_on_aoi)
+            for g in mapped_gaze
+        ]
+        for aoi_id, mapped_gaze in result.mapped_gaze.items()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay a recording and compare the results to the recorded ones"
+    )
+    parser.add_argument("recording")
+    args = parser.parse_args()
+
+    camera, surfaces, session = load_session(args.recording)
+    if session.get("dropped_frames"):
+        print(f"Recording dropped {session['dropped_frames']} frames")
+    # Gaze mapped independently of the frames can not be replayed frame by frame
+    full_rate_gaze = session.get("full_rate_gaze", False)
+    mapper = create_mapper(
+        camera, surfaces, smooth_gaze=session.get("smooth_gaze", False)
+    )
+
+    replayed_markers: List[tuple] = []
+    replayed_gaze: List[tuple] = []
+    for frame_index, _, image, gaze in read_frames(args.recording):
+        result = mapper.process_frame(image, [] if full_rate_gaze else gaze)
+        if result is None:
+            continue
+        replayed_markers.extend(
+            (index, uid, vertices.tolist())
+            for index, uid, vertices in _marker_rows(frame_index, result)
+        )
+        for aoi_id, rows in _mapped_gaze_rows(result).items():
+            replayed_gaze.extend((frame_index, ts, str(aoi_id), *r) for ts, *r in rows)
+
+    comparisons = [("markers", MARKER_COLUMNS, replayed_markers)]
+    if not full_rate_gaze:
+        comparisons.append(("mapped_gaze", MAPPED_GAZE_COLUMNS, replayed_gaze))
+    mismatches = 0
+    for name, columns, replayed in comparisons:
+        table = load_table(args.recording, name)
+        recorded = list(zip(*(table[c].tolist() for c in columns))) if table else []
+        table_mismatches = sum(a != b for a, b in zip(recorded, replayed))
+        table_mismatches += abs(len(recorded) - len(replayed))
+        print(f"{name}: replayed {len(replayed)} rows, {table_mismatches} mismatches")
+        mismatches += table_mismatches
+    if mismatches:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Regression tests for the buffer-reusing steady-state mode of `MarkerMapper`.
+
+Frames are rendered like in `marker_mapper_benchmark.py`. Run with `python -m pytest`
+from this directory.
+"""
+import numpy as np
+
+import marker_mapper_benchmark as benchmark
+import marker_mapper_lib
+
+RESOLUTION = (1088, 1080)
+
+
+def _render(frame_count: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    camera = benchmark._camera_for_resolution(RESOLUTION, None)
+    board = benchmark.render_board("keyboard", 1, benchmark.DEFAULT_MARKERS_DIR, rng)
+    frames = [
+        benchmark.render_frame(board, camera, RESOLUTION, rng)
+        for _ in range(frame_count)
+    ]
+    return camera, board, frames
+
+
+def test_reuse_buffers_allocates_no_frame_sized_arrays():
+    camera, board, frames = _render(frame_count=6)
+
+    def peak_bytes_per_frame(reuse_buffers: bool) -> float:
+        mapper = marker_mapper_lib.MarkerMapper(
+            camera, board.surfaces, reuse_buffers=reuse_buffers
+        )
+        allocations = benchmark.measure_allocations(mapper, frames)
+        return allocations["peak_bytes_per_frame"]
+
+    peak_with_reuse = peak_bytes_per_frame(reuse_buffers=True)
+    # Allocating the gray image alone takes a third of the frame's bytes
+    assert peak_with_reuse < frames[0].image.nbytes / 10
+    assert 10 * peak_with_reuse <= peak_bytes_per_frame(reuse_buffers=False)
+
+
+def test_reuse_buffers_keeps_flow_tracking_results():
+    camera, board, (frame,) = _render(frame_count=1)
+    # The board moves 3 pixels to the right per frame
+    images = [np.roll(frame.image, 3 * index, axis=1) for index in range(6)]
+
+    def track_markers(reuse_buffers: bool):
+        mapper = marker_mapper_lib.MarkerMapper(
+            camera,
+            board.surfaces,
+            flow_tracker=marker_mapper_lib.MarkerFlowTracker(),
+            reuse_buffers=reuse_buffers,
+        )
+        vertices = []
+        for image in images:
+            result = mapper.process_frame(image, frame.gaze)
+            markers = sorted(result.markers, key=lambda marker: str(marker.uid))
+            vertices.append(np.array([marker.vertices() for marker in markers]))
+        return vertices
+
+    for expected, actual in zip(track_markers(False), track_markers(True)):
+        np.testing.assert_allclose(actual, expected)
@@ -0,0 +1,34 @@
+"""Tests for `ParallelMarkerMapper`, run with `python -m pytest` from this directory."""
+import numpy as np
+
+import marker_mapper_benchmark as benchmark
+from marker_mapper_parallel import ParallelMarkerMapper
+
+RESOLUTION = (1088, 1080)
+
+
+def test_map_can_be_called_repeatedly():
+    rng = np.random.default_rng(0)
+    camera = benchmark._camera_for_resolution(RESOLUTION, None)
+    board = benchmark.render_board("keyboard", 1, benchmark.DEFAULT_MARKERS_DIR, rng)
+    # More frames than shared memory slots, so that slots have to be reused
+    frames = [
+        benchmark.render_frame(board, camera, RESOLUTION, rng) for _ in range(5)
+    ]
+
+    def marker_counts(results):
+        return [len(result.markers) for result in results]
+
+    with ParallelMarkerMapper(
+        camera, num_workers=2, frames_in_flight_per_worker=1
+    ) as mapper:
+        first = marker_counts(mapper.map((f.image, f.gaze) for f in frames))
+        second = marker_counts(mapper.map((f.image, f.gaze) for f in frames))
+        # A pass that is stopped early must give its slots back
+        results = mapper.map((f.image, f.gaze) for f in frames)
+        next(results)
+        results.close()
+        third = marker_counts(mapper.map((f.image, f.gaze) for f in frames))
+
+    assert len(first) == len(frames)
+    assert first == second == third
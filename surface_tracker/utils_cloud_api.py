@@ -1,7 +1,8 @@
 import json
 import logging
+import os
 import sys
-from typing import List
+from typing import List, Optional
 
 import requests
 
@@ -38,9 +39,25 @@ def camera_for_scene_cam_serial(
     serial_number_scene_cam: str = "default",
 ) -> RadialDistorsionCamera:
     intrinsics_scene_cam = load_camera_intrinsics(serial_number_scene_cam)
+    # Undistortion tables are cached next to the intrinsics
+    return camera_from_intrinsics(
+        intrinsics_scene_cam, cache_prefix=f"intrinsics.{serial_number_scene_cam}"
+    )
+
+
+def camera_from_intrinsics_file(path: str) -> RadialDistorsionCamera:
+    with open(path) as fh:
+        intrinsics = json.load(fh)
+    return camera_from_intrinsics(intrinsics, cache_prefix=os.path.splitext(path)[0])
+
+
+def camera_from_intrinsics(
+    intrinsics: "CloudIntrinsics", cache_prefix: Optional[str] = None
+) -> RadialDistorsionCamera:
     return RadialDistorsionCamera(
-        K=intrinsics_scene_cam["camera_matrix"],
-        D=intrinsics_scene_cam["dist_coefs"],
+        K=intrinsics["camera_matrix"],
+        D=intrinsics["dist_coefs"],
+        cache_prefix=cache_prefix,
     )
 
 
@@ -0,0 +1,233 @@
+import bisect
+import collections
+from math import inf
+from typing import DefaultDict, Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+import numpy.typing as npt
+
+# Latency bucket upper bounds in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128)
+QUANTILES = (0.5, 0.9, 0.99)
+
+STAGES = ("gray", "detect", "undistort", "locate", "map_gaze", "total")
+# Stages traced from the gaze timestamp to the client, see `ConnectionLatency`
+TRACE_STAGES = ("received", "detected", "mapped", "sent", "browser", "acknowledged")
+
+
+class RollingHistogram:
+    """Keeps the most recent `window` observations in a ring buffer for quantiles, and
+    cumulative bucket counts over all observations for Prometheus-style histograms.
+    """
+
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS, window: int = 1024):
+        self._buckets = list(buckets)
+        self._bucket_counts = [0] * (len(self._buckets) + 1)
+        self._window = np.zeros(window, dtype=np.float64)
+        self._count = 0
+        self._sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self._window[self._count % len(self._window)] = value
+        self._bucket_counts[bisect.bisect_left(self._buckets, value)] += 1
+        self._count += 1
+        self._sum += value
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    @property
+    def sum(self) -> float:
+        return self._sum
+
+    def recent(self) -> npt.NDArray[np.float64]:
+        """Copy of the most recent observations, oldest first"""
+        size = len(self._window)
+        if self._count <= size:
+            return self._window[: self._count].copy()
+        start = self._count % size
+        return np.concatenate((self._window[start:], self._window[:start]))
+
+    def quantiles(self, quantiles: Iterable[float] = QUANTILES) -> Dict[float, float]:
+        recent = self.recent()
+        if not len(recent):
+            return {q: float("nan") for q in quantiles}
+        return {q: float(np.quantile(recent, q)) for q in quantiles}
+
+    def cumulative_buckets(self) -> List[tuple]:
+        cumulative, total = [], 0
+        for bound, count in zip([*self._buckets, inf], self._bucket_counts):
+            total += count
+            cumulative.append((bound, total))
+        return cumulative
+
+
+class MarkerMapperMetrics:
+    """Low-overhead runtime statistics of a `MarkerMapper` pipeline.
+
+    Written from the capture thread and read from the server; readers may observe a
+    slightly inconsistent snapshot, which is acceptable for monitoring.
+    """
+
+    def __init__(self, window: int = 1024) -> None:
+        self.stage_latency = {s: RollingHistogram(window=window) for s in STAGES}
+        self.detected_markers = RollingHistogram(COUNT_BUCKETS, window=window)
+        self.surface_lookups: DefaultDict[str, int] = collections.defaultdict(int)
+        self.surface_located: DefaultDict[str, int] = collections.defaultdict(int)
+        self.frames_processed = 0
+        self.frames_dropped = 0
+        self.results_dropped = 0
+        self.recordings_dropped = 0
+        self._frame_period: Optional[float] = None
+        self._last_frame_timestamp: Optional[float] = None
+
+    def observe_stage(self, stage: str, seconds: float) -> None:
+        self.stage_latency[stage].observe(seconds)
+
+    def observe_frame(self, detected_markers: int) -> None:
+        self.frames_processed += 1
+        self.detected_markers.observe(detected_markers)
+
+    def observe_surface(self, surface_uid: str, located: bool) -> None:
+        self.surface_lookups[surface_uid] += 1
+        if located:
+            self.surface_located[surface_uid] += 1
+
+    def observe_frame_timestamp(self, timestamp: float) -> None:
+        """Estimate frames dropped before reaching the pipeline from timestamp gaps"""
+        if self._last_frame_timestamp is not None:
+            delta = timestamp - self._last_frame_timestamp
+            if self._frame_period is None:
+                self._frame_period = delta
+            elif delta > 1.5 * self._frame_period:
+                self.frames_dropped += int(round(delta / self._frame_period)) - 1
+            else:
+                self._frame_period = 0.95 * self._frame_period + 0.05 * delta
+        self._last_frame_timestamp = timestamp
+
+    def observe_dropped_results(self, count: int = 1) -> None:
+        self.results_dropped += count
+
+    def observe_dropped_recordings(self, count: int = 1) -> None:
+        self.recordings_dropped += count
+
+    def to_prometheus(self, prefix: str = "marker_mapper") -> str:
+        lines = []
+
+        name = f"{prefix}_stage_duration_seconds"
+        lines.append(f"# TYPE {name} histogram")
+        for stage, histogram in self.stage_latency.items():
+            lines.extend(_histogram_lines(name, histogram, f'stage="{stage}"'))
+        name = f"{prefix}_stage_duration_recent_seconds"
+        lines.append(f"# TYPE {name} gauge")
+        for stage, histogram in self.stage_latency.items():
+            for q, value in histogram.quantiles().items():
+                lines.append(f'{name}{{stage="{stage}",quantile="{q}"}} {value}')
+
+        name = f"{prefix}_detected_markers"
+        lines.append(f"# TYPE {name} histogram")
+        lines.extend(_histogram_lines(name, self.detected_markers))
+
+        for metric, values in (
+            ("surface_lookups_total", self.surface_lookups),
+            ("surface_located_total", self.surface_located),
+        ):
+            name = f"{prefix}_{metric}"
+            lines.append(f"# TYPE {name} counter")
+            for surface_uid, value in list(values.items()):
+                lines.append(f'{name}{{surface="{surface_uid}"}} {value}')
+
+        for metric, value in (
+            ("frames_processed_total", self.frames_processed),
+            ("frames_dropped_total", self.frames_dropped),
+            ("results_dropped_total", self.results_dropped),
+            ("recordings_dropped_total", self.recordings_dropped),
+        ):
+            name = f"{prefix}_{metric}"
+            lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+class ConnectionLatency:
+    """Latency of a client connection from the gaze timestamp to each trace stage.
+
+    The pipeline stages come from the result `stage_timestamps`, "sent" is taken when
+    a message leaves the server. Clients may acknowledge a gaze timestamp they showed;
+    the acknowledgment gives the round trip to the browser on the server clock, and
+    "browser" estimates the glass-to-browser latency as "sent" plus half of it.
+
+    Stage timestamps are taken on the server, so all latencies include the clock
+    offset between the device and the server.
+    """
+
+    def __init__(self, window: int = 1024, max_unacknowledged: int = 256) -> None:
+        self.stages = {s: RollingHistogram(window=window) for s in TRACE_STAGES}
+        self.round_trip = RollingHistogram(window=window)
+        self._max_unacknowledged = max_unacknowledged
+        self._unacknowledged: "collections.OrderedDict[float, float]" = (
+            collections.OrderedDict()
+        )
+
+    def observe_sent(
+        self,
+        stage_timestamps: Dict[str, float],
+        sent: float,
+        gaze_timestamps: Iterable[float] = (),
+    ) -> None:
+        """Record a message sent at `sent` containing the given gaze timestamps"""
+        gaze = stage_timestamps.get("gaze")
+        if gaze is not None:
+            for stage in ("received", "detected", "mapped"):
+                if stage in stage_timestamps:
+                    self.stages[stage].observe(stage_timestamps[stage] - gaze)
+            self.stages["sent"].observe(sent - gaze)
+
+        for timestamp in gaze_timestamps:
+            self._unacknowledged[timestamp] = sent
+        while len(self._unacknowledged) > self._max_unacknowledged:
+            self._unacknowledged.popitem(last=False)
+
+    def observe_acknowledged(self, gaze_timestamp: float, received: float) -> None:
+        sent = self._unacknowledged.pop(gaze_timestamp, None)
+        if sent is None:
+            return
+        round_trip = received - sent
+        self.round_trip.observe(round_trip)
+        self.stages["browser"].observe(sent - gaze_timestamp + round_trip / 2)
+        self.stages["acknowledged"].observe(received - gaze_timestamp)
+
+
+def connection_latency_prometheus(
+    connections: Dict[str, ConnectionLatency], prefix: str = "marker_mapper"
+) -> str:
+    """Recent latency quantiles of every connection, labeled by connection id"""
+    lines = []
+    name = f"{prefix}_connection_latency_seconds"
+    lines.append(f"# TYPE {name} gauge")
+    for connection, latency in list(connections.items()):
+        for stage, histogram in latency.stages.items():
+            for q, value in histogram.quantiles().items():
+                labels = f'connection="{connection}",stage="{stage}",quantile="{q}"'
+                lines.append(f"{name}{{{labels}}} {value}")
+    name = f"{prefix}_connection_round_trip_seconds"
+    lines.append(f"# TYPE {name} gauge")
+    for connection, latency in list(connections.items()):
+        for q, value in latency.round_trip.quantiles().items():
+            lines.append(f'{name}{{connection="{connection}",quantile="{q}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+
+def _histogram_lines(name: str, histogram: RollingHistogram, labels: str = "") -> list:
+    sep = "," if labels else ""
+    lines = []
+    for bound, count in histogram.cumulative_buckets():
+        le = "+Inf" if bound == inf else bound
+        lines.append(f'{name}_bucket{{{labels}{sep}le="{le}"}} {count}')
+    labels = f"{{{labels}}}" if labels else ""
+    lines.append(f"{name}_sum{labels} {histogram.sum}")
+    lines.append(f"{name}_count{labels} {histogram.count}")
+    return lines
@@ -0,0 +1,34 @@
+"""Helpers to shorten the time from process launch to the first mapped gaze."""
+import concurrent.futures
+import importlib
+from typing import Optional
+
+# Imports of OpenCV, the AprilTag bindings and the surface tracker dominate startup
+HEAVY_MODULES = ("cv2", "pupil_apriltags", "marker_mapper_lib", "utils_cloud_api")
+
+
+def preload_pipeline(
+    surface_definitions_path: Optional[str] = None,
+) -> "concurrent.futures.Future":
+    """Import the heavy modules and load the surface definitions in the background.
+
+    Meant to overlap with device discovery. The returned future resolves to the
+    loaded surfaces, or an empty list without `surface_definitions_path`.
+    """
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=1, thread_name_prefix="PipelinePreload"
+    )
+    future = executor.submit(_preload, surface_definitions_path)
+    executor.shutdown(wait=False)
+    return future
+
+
+def _preload(surface_definitions_path: Optional[str]) -> list:
+    for module in HEAVY_MODULES:
+        importlib.import_module(module)
+    if surface_definitions_path is None:
+        return []
+
+    import marker_mapper_lib
+
+    return marker_mapper_lib.load_core_surface_definitions(surface_definitions_path)
@@ -1,4 +1,5 @@
 import functools
+from typing import Dict, List, Optional
 
 import cv2
 import numpy as np
@@ -6,7 +7,95 @@ import numpy.typing as npt
 from pupil_labs.realtime_api import GazeData
 from pupil_labs.surface_tracker import SurfaceLocation
 
-from marker_mapper_lib import MarkerMappedGaze, RadialDistorsionCamera
+from marker_mapper_lib import (
+    MarkerMappedGaze,
+    MarkerMapperResult,
+    RadialDistorsionCamera,
+)
+
+AOI_COLOR = (255, 255, 0)
+AOI_TOP_COLOR = (0, 0, 255)
+MARKER_COLOR = (0, 255, 0)
+
+
+class MonitorRenderer:
+    """Draws mapper results for the monitor app, reusing its buffers between frames.
+
+    All overlay points of a frame are distorted in a single batch and drawn with one
+    call per color. Filled AoIs are only blended over their bounding rect.
+    """
+
+    def __init__(self, camera: RadialDistorsionCamera, num_points_per_edge: int = 20):
+        self._camera = camera
+        self._num_points_per_edge = num_points_per_edge
+        self._overlay: Optional[npt.NDArray[np.uint8]] = None
+        self._reference_buffers: Dict[str, npt.NDArray[np.uint8]] = {}
+
+    def draw_scene(
+        self, img: npt.NDArray[np.uint8], result: MarkerMapperResult, gaze: GazeData
+    ) -> npt.NDArray[np.uint8]:
+        edges, top_indices = _edge_points(self._num_points_per_edge)
+        located = [
+            (aoi_id, location)
+            for aoi_id, location in result.located_aois.items()
+            if location is not None
+        ]
+        points = [
+            np.asarray(marker.vertices(), dtype=np.float64).reshape((-1, 2))
+            for marker in result.markers
+        ]
+        points.extend(
+            location._map_from_surface_to_image(edges) for _, location in located
+        )
+
+        if points:
+            points = self._camera.distort_points_on_image_plane(np.concatenate(points))
+            points = np.asarray(points, dtype="int32")
+            num_marker_points = 4 * len(result.markers)
+            marker_outlines = points[:num_marker_points].reshape((-1, 4, 2))
+            aoi_outlines = points[num_marker_points:].reshape(
+                (len(located), len(edges), 2)
+            )
+
+            # Fill if gaze is on AoI
+            for (aoi_id, _), outline in zip(located, aoi_outlines):
+                if any(g.is_on_aoi for g in result.mapped_gaze[aoi_id]):
+                    self._overlay = _fill_bounding_rect(img, outline, self._overlay)
+
+            if len(marker_outlines):
+                cv2.polylines(
+                    img, marker_outlines, isClosed=True, color=MARKER_COLOR, thickness=1
+                )
+            if len(aoi_outlines):
+                cv2.polylines(
+                    img, aoi_outlines, isClosed=False, color=AOI_COLOR, thickness=5
+                )
+                cv2.polylines(
+                    img,
+                    np.ascontiguousarray(aoi_outlines[:, top_indices]),
+                    isClosed=False,
+                    color=AOI_TOP_COLOR,
+                    thickness=5,
+                )
+
+        draw_gaze_point(img, gaze)
+        return img
+
+    def draw_reference(
+        self,
+        name: str,
+        reference_img: npt.NDArray[np.uint8],
+        mapped_gaze: List[MarkerMappedGaze],
+    ) -> npt.NDArray[np.uint8]:
+        """Draw mapped gaze onto a copy of the reference image kept per `name`"""
+        buffer = self._reference_buffers.get(name)
+        if buffer is None or buffer.shape != reference_img.shape:
+            buffer = self._reference_buffers[name] = np.empty_like(reference_img)
+        np.copyto(buffer, reference_img)
+        for gaze in mapped_gaze:
+            if gaze.is_on_aoi:
+                draw_mapped_gaze_point(buffer, gaze)
+        return buffer
 
 
 def draw_aoi(
@@ -25,16 +114,13 @@ def draw_aoi(
     outline = np.asarray(points, dtype="int32").reshape((1, -1, 2))
 
     if fill:
-        alpha = 0.5
-        img_filled = img.copy()
-        cv2.fillPoly(img_filled, outline, color=(255, 255, 0))
-        cv2.addWeighted(img_filled, alpha, img, (1.0 - alpha), gamma=0, dst=img)
+        _fill_bounding_rect(img, outline[0])
 
     cv2.polylines(
         img,
         outline,
         isClosed=False,
-        color=(255, 255, 0),
+        color=AOI_COLOR,
         thickness=5,
     )
     # draw top edge in red
@@ -42,13 +128,40 @@ def draw_aoi(
         img,
         np.asarray(points[top_indices], dtype="int32").reshape((1, -1, 2)),
         isClosed=False,
-        color=(0, 0, 255),
+        color=AOI_TOP_COLOR,
         thickness=5,
     )
 
     return img
 
 
+def _fill_bounding_rect(
+    img: npt.NDArray[np.uint8],
+    outline: npt.NDArray[np.int32],
+    overlay: Optional[npt.NDArray[np.uint8]] = None,
+    alpha: float = 0.5,
+) -> Optional[npt.NDArray[np.uint8]]:
+    """Blend a filled polygon into `img`, touching only its bounding rect.
+
+    `overlay` is a scratch buffer of the same shape as `img`; it is (re)allocated if
+    needed and returned for reuse.
+    """
+    if overlay is None or overlay.shape != img.shape:
+        overlay = np.empty_like(img)
+    x, y, width, height = cv2.boundingRect(outline)
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + width, img.shape[1]), min(y + height, img.shape[0])
+    if x1 <= x0 or y1 <= y0:
+        return overlay
+
+    region = img[y0:y1, x0:x1]
+    overlay_region = overlay[y0:y1, x0:x1]
+    np.copyto(overlay_region, region)
+    cv2.fillPoly(overlay_region, outline[None], color=AOI_COLOR, offset=(-x0, -y0))
+    cv2.addWeighted(overlay_region, alpha, region, (1.0 - alpha), gamma=0, dst=region)
+    return overlay
+
+
 @functools.lru_cache()
 def _edge_points(num_points_per_edge: int):
     zero_to_one = np.linspace(0, 1, num_points_per_edge)
@@ -77,7 +190,6 @@ def draw_gaze_point(img, gaze: GazeData):
 
 
 def draw_mapped_gaze_point(img: npt.NDArray[np.uint8], gaze: MarkerMappedGaze):
-    img = img.copy()
     x = int(gaze.x * img.shape[1])
     y = int((1.0 - gaze.y) * img.shape[0])
     cv2.circle(img, (x, y), radius=40, color=(0, 0, 255), thickness=10)
@@ -85,14 +197,16 @@ def draw_mapped_gaze_point(img: npt.NDArray[np.uint8], gaze: MarkerMappedGaze):
 
 
 def draw_marker_outlines(img, markers, camera: RadialDistorsionCamera):
-    for marker in markers:
-        cv2.polylines(
-            img,
-            np.array(
-                camera.distort_points_on_image_plane(marker.vertices()),
-                dtype="int32",
-            ).reshape((-1, 4, 2)),
-            isClosed=True,
-            color=(0, 255, 0),
-            thickness=1,
-        )
+    if not markers:
+        return
+    vertices = np.array([marker.vertices() for marker in markers], dtype=np.float64)
+    cv2.polylines(
+        img,
+        np.array(
+            camera.distort_points_on_image_plane(vertices),
+            dtype="int32",
+        ).reshape((-1, 4, 2)),
+        isClosed=True,
+        color=MARKER_COLOR,
+        thickness=1,
+    )